@@ -7,6 +7,7 @@ import os
 from typing import List, Optional
 
 from qllama import __version__
+from qllama.models import MODEL_REGISTRY, resolve_model_name
 from qllama.terminal import QllamaTerminal
 
 _logger = logging.getLogger(__name__)
@@ -25,14 +26,22 @@ def setup_logging(loglevel: int) -> None:
         datefmt="%Y-%m-%d %H:%M:%S"
     )
 
-def parse_args(args: List[str]) -> argparse.Namespace:
-    """Parse command line parameters.
+def _model_name(value: str) -> str:
+    """Map a model name or alias to its registry key so argparse can check it."""
+    return resolve_model_name(value) or value
+
+def _non_negative_int(value: str) -> int:
+    """Parse a count that may be zero but not negative."""
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"must be 0 or greater, got {value}")
+    return number
+
+def build_parser() -> argparse.ArgumentParser:
+    """Build the command line parser.
     
-    Args:
-        args: Command line parameters as list of strings
-        
     Returns:
-        Command line parameters namespace
+        The argument parser for qllama
     """
     parser = argparse.ArgumentParser(description="qllama - an alternative to ollama with low-level model access")
     parser.add_argument(
@@ -61,10 +70,17 @@ def parse_args(args: List[str]) -> argparse.Namespace:
     
     # Run command
     run_parser = subparsers.add_parser("run", help="Run a model in interactive mode")
-    run_parser.add_argument("model", help="Model name to run")
+    run_parser.add_argument(
+        "model",
+        type=_model_name,
+        choices=list(MODEL_REGISTRY.keys()),
+        help="Model name to run",
+    )
     run_parser.add_argument("--device", help="Device to use (cpu, cuda)", default="cuda")
     run_parser.add_argument("--temperature", type=float, help="Temperature for generation", default=1.0)
     run_parser.add_argument("--max-tokens", type=int, help="Maximum tokens to generate", default=64)
+    run_parser.add_argument("--max-history-turns", type=_non_negative_int, help="Number of past exchanges kept as context", default=16)
+    run_parser.add_argument("--batch-size", type=int, help="Answer up to this many queued prompts in one batch (max 4)", default=1)
     
     # List command
     list_parser = subparsers.add_parser("list", help="List available models")
@@ -72,7 +88,18 @@ def parse_args(args: List[str]) -> argparse.Namespace:
     # Help command
     help_parser = subparsers.add_parser("help", help="Show help for a command")
     
-    return parser.parse_args(args)
+    return parser
+
+def parse_args(args: List[str]) -> argparse.Namespace:
+    """Parse command line parameters.
+    
+    Args:
+        args: Command line parameters as list of strings
+        
+    Returns:
+        Command line parameters namespace
+    """
+    return build_parser().parse_args(args)
 
 def main(args: List[str]) -> None:
     """Main entry point allowing external calls.
@@ -80,7 +107,8 @@ def main(args: List[str]) -> None:
     Args:
         args: Command line parameters as list of strings
     """
-    parsed_args = parse_args(args)
+    parser = build_parser()
+    parsed_args = parser.parse_args(args)
     setup_logging(parsed_args.loglevel)
     
     _logger.debug("Starting qllama...")
@@ -92,6 +120,8 @@ def main(args: List[str]) -> None:
                 device=parsed_args.device,
                 temperature=parsed_args.temperature,
                 max_tokens=parsed_args.max_tokens,
+                max_history_turns=parsed_args.max_history_turns,
+                batch_size=parsed_args.batch_size,
             )
             term.run()
         except ImportError as e:
@@ -112,23 +142,14 @@ def main(args: List[str]) -> None:
                 # Re-raise if it's not a PIL-related issue
                 raise
     elif parsed_args.command == "list":
-        try:
-            from qllama.models import MODEL_REGISTRY
-            print("Available models:")
-            for model in MODEL_REGISTRY:
-                print(f"  - {model}")
-        except ImportError as e:
-            if "PIL" in str(e) or "_imaging" in str(e):
-                print("\nError: PIL (Pillow) is not properly installed.")
-                print("Run 'pip uninstall -y pillow && pip install --no-cache-dir pillow' to fix the issue.")
-                sys.exit(1)
-            else:
-                raise
+        print("Available models:")
+        for model in MODEL_REGISTRY:
+            print(f"  - {model}")
     elif parsed_args.command == "help" or parsed_args.command is None:
-        parse_args(["--help"])
+        parser.print_help()
     else:
         _logger.error(f"Unknown command: {parsed_args.command}")
-        parse_args(["--help"])
+        parser.print_help()
 
 def run() -> None:
     """Entry point for console_scripts."""
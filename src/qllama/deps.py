@@ -1,5 +1,6 @@
 """Dependency checker for qllama."""
 
+import functools
 import logging
 import importlib.util
 import sys
@@ -7,9 +8,12 @@ from typing import Dict, List, Tuple
 
 _logger = logging.getLogger(__name__)
 
+@functools.lru_cache(maxsize=1)
 def check_dependencies() -> List[Tuple[str, str, bool]]:
     """Check if all required dependencies are installed.
     
+    The result is cached, so the imports are only probed once per process.
+    
     Returns:
         List of (package_name, error_message, is_critical) tuples
     """
@@ -1,10 +1,11 @@
 """Models package for qllama."""
 
 from importlib import import_module
-from typing import Dict, Any, Optional
+from typing import TYPE_CHECKING, Dict, Any, Optional
 import logging
 
-from .base import BaseModelHandler
+if TYPE_CHECKING:
+    from .base import BaseModelHandler
 
 _logger = logging.getLogger(__name__)
 
@@ -14,7 +15,40 @@ MODEL_REGISTRY = {
     # Add more models here as they're implemented
 }
 
-def get_model_handler(model_name: str, **kwargs) -> BaseModelHandler:
+# Alternative names accepted for registered models
+MODEL_ALIASES = {
+    "smolvlm2-2.2b": "smolvlm2",
+    "smolvlm2-2.2b-instruct": "smolvlm2",
+    "mistral-7b": "mistral",
+    "mistral-7b-instruct": "mistral",
+}
+
+# Characters ignored when matching model names
+_STRIP_TABLE = str.maketrans("", "", "-_")
+
+def _normalize(model_name: str) -> str:
+    """Normalize a model name for lookup."""
+    return model_name.translate(_STRIP_TABLE).lower()
+
+# Normalized model and alias names mapped to their MODEL_REGISTRY key
+_NORMALIZED_KEYS: Dict[str, str] = {_normalize(key): key for key in MODEL_REGISTRY}
+_NORMALIZED_KEYS.update({_normalize(alias): key for alias, key in MODEL_ALIASES.items()})
+
+def resolve_model_name(model_name: str) -> Optional[str]:
+    """Get the MODEL_REGISTRY key for a model name or alias.
+    
+    Args:
+        model_name: A model name in any supported spelling
+        
+    Returns:
+        The registry key, or None if the model is unknown
+    """
+    return _NORMALIZED_KEYS.get(_normalize(model_name))
+
+# Handler classes resolved from MODEL_REGISTRY, keyed by registry key
+_HANDLER_CACHE: Dict[str, type] = {}
+
+def get_model_handler(model_name: str, **kwargs) -> "BaseModelHandler":
     """Get a model handler for the specified model.
     
     Args:
@@ -24,17 +58,22 @@ def get_model_handler(model_name: str, **kwargs) -> BaseModelHandler:
     Returns:
         An instance of a model handler
     """
-    model_key = model_name.lower().replace("-", "").replace("_", "")
+    model_key = resolve_model_name(model_name)
     
-    if model_key not in MODEL_REGISTRY:
+    if model_key is None:
         raise ValueError(f"Unknown model: {model_name}. Available models: {', '.join(MODEL_REGISTRY.keys())}")
     
+    handler_class = _HANDLER_CACHE.get(model_key)
+    if handler_class is not None:
+        return handler_class(model_name=model_name, **kwargs)
+    
     handler_path = MODEL_REGISTRY[model_key]
     module_path, class_name = handler_path.rsplit(".", 1)
     
     try:
         module = import_module(module_path)
         handler_class = getattr(module, class_name)
+        _HANDLER_CACHE[model_key] = handler_class
         return handler_class(model_name=model_name, **kwargs)
     except (ImportError, AttributeError) as e:
         _logger.error(f"Failed to load handler for model {model_name}: {e}")
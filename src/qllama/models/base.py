@@ -1,11 +1,59 @@
 """Base model handler for qllama."""
 
+import functools
 import logging
+import threading
 from abc import ABC, abstractmethod
-from typing import Dict, List, Any, Optional, Union
+from typing import Callable, Dict, Iterator, List, Any, Optional, Union
 
 _logger = logging.getLogger(__name__)
 
+@functools.lru_cache(maxsize=1)
+def _is_cuda_available() -> bool:
+    """Check if CUDA is available (probed once per process)."""
+    try:
+        import torch
+        return torch.cuda.is_available()
+    except ImportError:
+        return False
+
+@functools.lru_cache(maxsize=1)
+def _enable_tf32() -> None:
+    """Allow TF32 tensor-core math for fp32 matmuls and convolutions (once per process)."""
+    import torch
+    
+    torch.set_float32_matmul_precision("high")
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    # Image sizes are fixed by the processors, so autotuned conv kernels stay valid
+    torch.backends.cudnn.benchmark = True
+
+@functools.lru_cache(maxsize=None)
+def _copy_stream(device: str) -> Any:
+    """Get the side CUDA stream used for host-to-device input copies on a device."""
+    import torch
+    
+    return torch.cuda.Stream(device=device)
+
+@functools.lru_cache(maxsize=1)
+def _stop_on_event_class() -> type:
+    """Build the ``StoppingCriteria`` subclass that ends generation when an event is set."""
+    import torch
+    from transformers import StoppingCriteria
+    
+    class StopOnEvent(StoppingCriteria):
+        """Stop every sequence once ``stop_event`` is set (e.g. the reader went away)."""
+        
+        def __init__(self, stop_event: threading.Event):
+            self.stop_event = stop_event
+        
+        def __call__(self, input_ids: "torch.Tensor", scores: "torch.Tensor", **kwargs) -> "torch.Tensor":
+            return torch.full(
+                (input_ids.shape[0],), self.stop_event.is_set(), dtype=torch.bool, device=input_ids.device
+            )
+    
+    return StopOnEvent
+
 class BaseModelHandler(ABC):
     """Base class for all model handlers in qllama."""
     
@@ -19,17 +67,10 @@ class BaseModelHandler(ABC):
         self.model_name = model_name
         self.model = None
         self.processor = None
-        self.device = kwargs.get("device", "cuda" if self._is_cuda_available() else "cpu")
+        self.device = kwargs.get("device", "cuda" if _is_cuda_available() else "cpu")
         _logger.info(f"Initializing {self.__class__.__name__} for model {model_name} on {self.device}")
-    
-    @staticmethod
-    def _is_cuda_available() -> bool:
-        """Check if CUDA is available."""
-        try:
-            import torch
-            return torch.cuda.is_available()
-        except ImportError:
-            return False
+        if str(self.device).startswith("cuda"):
+            _enable_tf32()
     
     @abstractmethod
     def load_model(self) -> None:
@@ -37,18 +78,148 @@ class BaseModelHandler(ABC):
         pass
     
     @abstractmethod
-    def generate(self, messages: List[Dict[str, Any]], **kwargs) -> str:
+    def generate(self, messages: List[Dict[str, Any]], **kwargs) -> Union[str, Iterator[str]]:
         """Generate a response from the model.
         
         Args:
             messages: A list of message dictionaries
-            **kwargs: Additional generation parameters
+            **kwargs: Additional generation parameters. Pass ``stream=True`` to
+                get an iterator over text chunks instead of the full response.
             
         Returns:
-            The generated text response
+            The generated text response, or an iterator of text chunks when streaming
         """
         pass
     
+    def generate_stream(self, messages: List[Dict[str, Any]], **kwargs) -> Iterator[str]:
+        """Generate a response from the model, yielding text as it is produced.
+        
+        Args:
+            messages: A list of message dictionaries
+            **kwargs: Additional generation parameters
+            
+        Returns:
+            An iterator of text chunks; handlers that cannot stream yield the
+            full response as a single chunk
+        """
+        response = self.generate(messages, stream=True, **kwargs)
+        if isinstance(response, str):
+            return iter((response,))
+        return response
+    
+    def generate_batch(self, conversations: List[List[Dict[str, Any]]], **kwargs) -> List[str]:
+        """Generate responses for several independent conversations.
+    
+        Handlers that can pad prompts into one batch override this; the default
+        answers the conversations one after another.
+    
+        Args:
+            conversations: A list of message lists, one per prompt
+            **kwargs: Additional generation parameters
+    
+        Returns:
+            The generated text responses, in the order of ``conversations``
+        """
+        kwargs.pop("stream", None)
+        return [self.generate(messages, **kwargs) for messages in conversations]
+    
+    @staticmethod
+    def _stopping_criteria(stop_event: threading.Event) -> Any:
+        """Build ``generate`` stopping criteria that end generation once stop_event is set.
+        
+        Args:
+            stop_event: Event set by the consumer of a streamed response
+            
+        Returns:
+            A ``transformers.StoppingCriteriaList``
+        """
+        from transformers import StoppingCriteriaList
+        
+        return StoppingCriteriaList([_stop_on_event_class()(stop_event)])
+    
+    @staticmethod
+    def _stream_generation(generate_fn: Callable[[threading.Event], Any], streamer: Any) -> Iterator[str]:
+        """Run generation on a background thread and iterate over its output.
+        
+        If the consumer stops iterating early (Ctrl-C, ``close()``), the event
+        passed to ``generate_fn`` is set before waiting for the thread, so
+        generation should check it (see ``_stopping_criteria``) and return.
+        
+        Args:
+            generate_fn: Callable running generation that feeds ``streamer``;
+                it receives a ``threading.Event`` asking it to stop
+            streamer: A ``transformers.TextIteratorStreamer``
+            
+        Returns:
+            An iterator yielding decoded text chunks as they are produced
+        """
+        errors = []
+        stop_event = threading.Event()
+        
+        def target() -> None:
+            try:
+                generate_fn(stop_event)
+            except Exception as e:
+                errors.append(e)
+                # Unblock the consumer; the error is re-raised once it stops iterating
+                streamer.end()
+        
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        
+        def chunks() -> Iterator[str]:
+            try:
+                yield from streamer
+            finally:
+                stop_event.set()
+                # Generation ends at its next step; keep waiting through a repeated Ctrl-C so
+                # the thread can't still be updating handler state when the next turn starts
+                while thread.is_alive():
+                    try:
+                        thread.join()
+                    except KeyboardInterrupt:
+                        pass
+            if errors:
+                raise errors[0]
+        
+        return chunks()
+    
+    @staticmethod
+    def _move_inputs(inputs: Any, device: Any, dtype: Any = None) -> Any:
+        """Move processed inputs to a device.
+        
+        On CUDA the tensors are staged in pinned host memory and copied with
+        ``non_blocking=True`` on a dedicated stream, so the transfer overlaps
+        with host-side work and with kernels still running on the compute stream.
+        
+        Args:
+            inputs: A ``BatchEncoding``/``BatchFeature`` of tensors
+            device: The target device
+            dtype: Optional dtype for floating point tensors
+            
+        Returns:
+            The inputs, moved to ``device``
+        """
+        if not str(device).startswith("cuda"):
+            return inputs.to(device) if dtype is None else inputs.to(device, dtype=dtype)
+        
+        import torch
+        
+        compute_stream = torch.cuda.current_stream(device)
+        copy_stream = _copy_stream(str(device))
+        with torch.cuda.stream(copy_stream):
+            for key, value in inputs.items():
+                if isinstance(value, torch.Tensor):
+                    value = value.pin_memory().to(device, non_blocking=True)
+                    if dtype is not None and value.is_floating_point():
+                        value = value.to(dtype)
+                    # The tensor is used on the compute stream; keep its memory from being reused early
+                    value.record_stream(compute_stream)
+                    inputs[key] = value
+        # Work queued on the compute stream afterwards waits for the copies
+        compute_stream.wait_stream(copy_stream)
+        return inputs
+    
     def process_messages(self, messages: List[Dict[str, Any]]) -> Any:
         """Process messages into model inputs.
         
@@ -1,15 +1,36 @@
 """Handler for Mistral models."""
 
+import copy
+import importlib.util
 import logging
-from typing import Dict, List, Any, Optional
-
-import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Dict, Iterator, List, Any, Optional, Tuple, Union
 
 from ..base import BaseModelHandler
 
+# torch and transformers are imported where they are used so that importing
+# this module (e.g. for the model registry) stays cheap
+if TYPE_CHECKING:
+    import torch
+    from transformers import DynamicCache, GenerationConfig
+
 _logger = logging.getLogger(__name__)
 
+# Maximum number of tokenized prompts kept per handler
+_PROMPT_CACHE_SIZE = 32
+
+# Generation parameters callers may override per call
+_GENERATION_KEYS = ("do_sample", "max_new_tokens", "temperature", "top_p")
+
+# Supported weight-only quantization modes (None loads full-precision weights)
+_QUANTIZATION_MODES = (None, "nf4", "int8")
+
+def _default_attn_implementation(device: str) -> str:
+    """Pick FlashAttention-2 when it can be used, otherwise PyTorch SDPA."""
+    if str(device).startswith("cuda") and importlib.util.find_spec("flash_attn") is not None:
+        return "flash_attention_2"
+    return "sdpa"
+
 class MistralHandler(BaseModelHandler):
     """Handler for Mistral models."""
     
@@ -18,38 +39,129 @@ class MistralHandler(BaseModelHandler):
         
         Args:
             model_name: The name or path of the Mistral model
-            **kwargs: Additional model-specific arguments
+            **kwargs: Additional model-specific arguments. ``quantization`` may be
+                "nf4" or "int8" to load weights through bitsandbytes;
+                ``compile_model=True`` compiles the forward pass on CUDA.
         """
+        import torch
+        
         super().__init__(model_name=model_name, **kwargs)
         self.torch_dtype = kwargs.get("torch_dtype", torch.bfloat16)
+        self.attn_implementation = kwargs.get(
+            "attn_implementation", _default_attn_implementation(self.device)
+        )
+        self.quantization = kwargs.get("quantization")
+        if self.quantization not in _QUANTIZATION_MODES:
+            raise ValueError(
+                f"Unknown quantization: {self.quantization}. "
+                f"Available modes: {', '.join(str(mode) for mode in _QUANTIZATION_MODES)}"
+            )
+        # Tokenized prompts keyed by the (role, content) pairs they were built from
+        self._prompt_cache: "OrderedDict[Tuple[Tuple[str, str], ...], Any]" = OrderedDict()
+        # Key/value cache of the previous turn and the token ids it covers
+        self.reuse_kv_cache = kwargs.get("reuse_kv_cache", True)
+        # Opt-in: compiled CUDA graphs need a static cache, which rules out reuse across turns
+        self.compile_model = kwargs.get("compile_model", False)
+        self._kv_cache: Optional["DynamicCache"] = None
+        self._cached_input_ids: Optional["torch.Tensor"] = None
         
     def load_model(self) -> None:
         """Load the Mistral model and tokenizer."""
+        from transformers import AutoTokenizer, AutoModelForCausalLM, GenerationConfig
+        
         _logger.info(f"Loading Mistral model: {self.model_name}")
         
         try:
             self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
             self.model = AutoModelForCausalLM.from_pretrained(
                 self.model_name,
-                torch_dtype=self.torch_dtype,
-                device_map=self.device
+                device_map=self.device,
+                attn_implementation=self.attn_implementation,
+                **self._weight_kwargs()
             )
             self.processor = self.tokenizer  # Alias for consistency
+            # Default generation parameters, copied and overridden per call
+            self._gen_config = GenerationConfig(
+                do_sample=True,
+                max_new_tokens=128,
+                temperature=0.7,
+                top_p=0.9,
+                pad_token_id=self.tokenizer.eos_token_id,
+            )
+            self._kv_cache = None
+            self._cached_input_ids = None
+            # Compiled graphs don't play well with bitsandbytes kernels
+            if self.compile_model and self.quantization is None:
+                self._compile_forward()
             _logger.info("Successfully loaded Mistral model and tokenizer")
         except Exception as e:
             _logger.error(f"Failed to load Mistral model: {e}")
             raise
     
-    def process_messages(self, messages: List[Dict[str, Any]]) -> Dict[str, torch.Tensor]:
-        """Process messages for Mistral.
+    def _weight_kwargs(self) -> Dict[str, Any]:
+        """Build the dtype/quantization arguments for ``from_pretrained``."""
+        if self.quantization is None:
+            return {"torch_dtype": self.torch_dtype}
+        
+        from transformers import BitsAndBytesConfig
+        
+        if self.quantization == "nf4":
+            return {
+                "quantization_config": BitsAndBytesConfig(
+                    load_in_4bit=True,
+                    bnb_4bit_quant_type="nf4",
+                    bnb_4bit_compute_dtype=self.torch_dtype,
+                    bnb_4bit_use_double_quant=True,
+                )
+            }
+        return {"quantization_config": BitsAndBytesConfig(load_in_8bit=True)}
+    
+    def _compile_forward(self) -> None:
+        """Compile the model forward pass to cut per-token dispatch overhead on CUDA.
+        
+        CUDA graphs ("reduce-overhead") need fixed tensor shapes, so generation
+        switches to a static key/value cache and stops reusing the cache across
+        turns. If compilation or the warm-up fails, the model runs uncompiled.
+        """
+        import torch
+        
+        torch_version = tuple(int(part) for part in torch.__version__.split("+")[0].split(".")[:2])
+        if torch_version < (2, 1) or not str(self.device).startswith("cuda"):
+            _logger.debug("Skipping torch.compile (requires torch>=2.1 and a CUDA device)")
+            return
+        
+        _logger.info("Compiling Mistral forward pass")
+        eager_forward = self.model.forward
+        reuse_kv_cache = self.reuse_kv_cache
+        try:
+            self.model.forward = torch.compile(eager_forward, mode="reduce-overhead", fullgraph=False)
+            self._gen_config.cache_implementation = "static"
+            self.reuse_kv_cache = False
+            
+            # Warm up (prefill plus one decode step) so compilation is paid here
+            # rather than on the first prompt
+            warmup_inputs = self.tokenizer("Hello", return_tensors="pt").to(self.device)
+            with torch.inference_mode():
+                self.model.generate(
+                    **warmup_inputs,
+                    generation_config=self._generation_config(max_new_tokens=2),
+                )
+        except Exception as e:
+            _logger.warning(f"torch.compile failed, running the model uncompiled: {e}")
+            self.model.forward = eager_forward
+            self._gen_config.cache_implementation = None
+            self.reuse_kv_cache = reuse_kv_cache
+    
+    @staticmethod
+    def _build_conversation(messages: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+        """Convert messages to the text-only turns expected by the chat template.
         
         Args:
             messages: A list of message dictionaries
             
         Returns:
-            Processed inputs ready for the model
+            A list of ``{"role", "content"}`` dictionaries
         """
-        # Convert to the format expected by the model
         conversation = []
         
         for message in messages:
@@ -65,12 +177,36 @@ class MistralHandler(BaseModelHandler):
                 if isinstance(message["content"], str):
                     content = message["content"]
                 elif isinstance(message["content"], list):
-                    for item in message["content"]:
-                        if isinstance(item, dict) and item.get("type") == "text":
-                            content += item.get("text", "") + " "
+                    content = " ".join(
+                        item.get("text", "") for item in message["content"]
+                        if isinstance(item, dict) and item.get("type") == "text"
+                    )
             
             conversation.append({"role": role, "content": content.strip()})
         
+        return conversation
+    
+    def process_messages(self, messages: List[Dict[str, Any]]) -> Dict[str, "torch.Tensor"]:
+        """Process messages for Mistral.
+        
+        Args:
+            messages: A list of message dictionaries
+            
+        Returns:
+            Processed inputs ready for the model
+        """
+        conversation = self._build_conversation(messages)
+        
+        # Reuse the tokenized prompt if this exact conversation was seen recently
+        cache_key = tuple((turn["role"], turn["content"]) for turn in conversation)
+        inputs = self._prompt_cache.get(cache_key)
+        if inputs is not None:
+            self._prompt_cache.move_to_end(cache_key)
+            if inputs["input_ids"].device != self.model.device:
+                inputs = inputs.to(self.model.device)
+                self._prompt_cache[cache_key] = inputs
+            return inputs
+        
         # Format the conversation
         prompt = self.tokenizer.apply_chat_template(
             conversation, 
@@ -79,43 +215,184 @@ class MistralHandler(BaseModelHandler):
         )
         
         # Tokenize
-        inputs = self.tokenizer(prompt, return_tensors="pt").to(self.device)
+        inputs = self._move_inputs(self.tokenizer(prompt, return_tensors="pt"), self.device)
+        
+        self._prompt_cache[cache_key] = inputs
+        if len(self._prompt_cache) > _PROMPT_CACHE_SIZE:
+            self._prompt_cache.popitem(last=False)
         
         return inputs
     
-    def generate(self, messages: List[Dict[str, Any]], **kwargs) -> str:
+    def _reusable_kv_cache(self, input_ids: "torch.Tensor") -> "DynamicCache":
+        """Get a key/value cache covering the longest reusable prefix of a prompt.
+        
+        Args:
+            input_ids: Token ids of the new prompt, shape (1, seq_len)
+            
+        Returns:
+            The previous turn's cache cropped to the shared prefix, or an empty cache
+        """
+        from transformers import DynamicCache
+        
+        if self._kv_cache is None or self._cached_input_ids is None:
+            return DynamicCache()
+        
+        # Leave at least one prompt token uncached so generate has something to prefill
+        limit = min(
+            self._kv_cache.get_seq_length(),
+            self._cached_input_ids.shape[0],
+            input_ids.shape[1] - 1,
+        )
+        mismatches = (self._cached_input_ids[:limit] != input_ids[0, :limit]).nonzero()
+        prefix_len = mismatches[0].item() if len(mismatches) else limit
+        
+        if prefix_len <= 0:
+            return DynamicCache()
+        
+        _logger.debug(f"Reusing {prefix_len} cached tokens of {input_ids.shape[1]}")
+        self._kv_cache.crop(prefix_len)
+        return self._kv_cache
+    
+    def _run_generate(
+        self,
+        inputs: Dict[str, "torch.Tensor"],
+        generation_config: "GenerationConfig",
+        **generate_kwargs,
+    ) -> "torch.Tensor":
+        """Run ``model.generate``, reusing the key/value cache when enabled.
+        
+        Args:
+            inputs: Tokenized prompt
+            generation_config: Generation parameters for this call
+            **generate_kwargs: Extra arguments for ``model.generate`` (e.g. a streamer)
+            
+        Returns:
+            The prompt and generated token ids
+        """
+        import torch
+        
+        # inference_mode is thread-local, so it is entered here for streamed calls too
+        with torch.inference_mode():
+            if not self.reuse_kv_cache:
+                return self.model.generate(**inputs, generation_config=generation_config, **generate_kwargs)
+            
+            # Prefill only the part of the prompt not already cached
+            past_key_values = self._reusable_kv_cache(inputs["input_ids"])
+            # generate extends the cache in place; forget it until the call succeeds so a
+            # failed or interrupted turn can't leave keys/values that don't match the ids
+            self._kv_cache = None
+            self._cached_input_ids = None
+            output = self.model.generate(
+                **inputs,
+                generation_config=generation_config,
+                past_key_values=past_key_values,
+                use_cache=True,
+                **generate_kwargs,
+            )
+            self._kv_cache = past_key_values
+            self._cached_input_ids = output[0]
+        
+        return output
+    
+    def _generation_config(self, **kwargs) -> "GenerationConfig":
+        """Copy the default generation parameters with per-call overrides applied."""
+        generation_config = copy.deepcopy(self._gen_config)
+        generation_config.update(**{k: v for k, v in kwargs.items() if k in _GENERATION_KEYS})
+        return generation_config
+    
+    def generate(self, messages: List[Dict[str, Any]], **kwargs) -> Union[str, Iterator[str]]:
         """Generate a response from the Mistral model.
         
         Args:
             messages: A list of message dictionaries
-            **kwargs: Additional generation parameters
+            **kwargs: Additional generation parameters; ``stream=True`` returns
+                an iterator over text chunks
             
         Returns:
-            The generated text response
+            The generated text response, or an iterator of text chunks when streaming
         """
         if self.model is None:
             self.load_model()
         
         inputs = self.process_messages(messages)
         
-        # Set generation parameters with sensible defaults
-        generation_kwargs = {
-            "do_sample": kwargs.get("do_sample", True),
-            "max_new_tokens": kwargs.get("max_new_tokens", 128),
-            "temperature": kwargs.get("temperature", 0.7),
-            "top_p": kwargs.get("top_p", 0.9),
-        }
+        # Apply per-call overrides on top of the defaults built in load_model
+        generation_config = self._generation_config(**kwargs)
         
-        _logger.debug(f"Generating with parameters: {generation_kwargs}")
+        _logger.debug(f"Generating with parameters: {generation_config.to_diff_dict()}")
         
-        # Generate text
-        with torch.no_grad():
-            output = self.model.generate(**inputs, **generation_kwargs)
+        if kwargs.get("stream"):
+            from transformers import TextIteratorStreamer
+            
+            streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+            return self._stream_generation(
+                lambda stop_event: self._run_generate(
+                    inputs,
+                    generation_config,
+                    streamer=streamer,
+                    stopping_criteria=self._stopping_criteria(stop_event),
+                ),
+                streamer,
+            )
         
-        # Decode the generated ids
-        generated_text = self.tokenizer.decode(output[0], skip_special_tokens=True)
+        output = self._run_generate(inputs, generation_config)
         
-        # Extract only the newly generated part
-        response = generated_text[len(self.tokenizer.decode(inputs["input_ids"][0], skip_special_tokens=True)):]
+        # Decode only the newly generated ids
+        prompt_len = inputs["input_ids"].shape[1]
+        response = self.tokenizer.decode(output[0, prompt_len:], skip_special_tokens=True)
         
         return response.strip()
+    
+    def generate_batch(self, conversations: List[List[Dict[str, Any]]], **kwargs) -> List[str]:
+        """Generate responses for several conversations with a single ``generate`` call.
+        
+        Prompts are left-padded into one batch so the decode steps are shared.
+        The key/value cache reused across turns is left untouched.
+        
+        Args:
+            conversations: A list of message lists, one per independent prompt
+            **kwargs: Additional generation parameters
+            
+        Returns:
+            The generated text responses, in the order of ``conversations``
+        """
+        if len(conversations) <= 1:
+            kwargs.pop("stream", None)
+            return [self.generate(messages, **kwargs) for messages in conversations]
+        
+        import torch
+        
+        if self.model is None:
+            self.load_model()
+        
+        prompts = [
+            self.tokenizer.apply_chat_template(
+                self._build_conversation(messages),
+                tokenize=False,
+                add_generation_prompt=True
+            )
+            for messages in conversations
+        ]
+        
+        # Decoder-only models must be padded on the left so every row ends at the prompt
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        padding_side = self.tokenizer.padding_side
+        self.tokenizer.padding_side = "left"
+        try:
+            inputs = self.tokenizer(prompts, return_tensors="pt", padding=True)
+        finally:
+            self.tokenizer.padding_side = padding_side
+        inputs = self._move_inputs(inputs, self.device)
+        
+        generation_config = self._generation_config(**kwargs)
+        _logger.debug(f"Generating a batch of {len(prompts)} with parameters: {generation_config.to_diff_dict()}")
+        
+        with torch.inference_mode():
+            output = self.model.generate(**inputs, generation_config=generation_config)
+        
+        # Every row shares the padded prompt length
+        prompt_len = inputs["input_ids"].shape[1]
+        responses = self.tokenizer.batch_decode(output[:, prompt_len:], skip_special_tokens=True)
+        
+        return [response.strip() for response in responses]
@@ -1,18 +1,98 @@
 """Handler for SmolVLM2 model."""
 
+import hashlib
 import logging
-from typing import Dict, List, Any, Optional
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, Iterator, List, Any, Optional, Tuple, Union
 import os
 import sys
 
-import torch
-from transformers import AutoProcessor, AutoModelForImageTextToText
-
 from ..base import BaseModelHandler
-from ...utils import load_image, load_video
+from ...utils import load_attachments
+
+# torch and transformers are imported where they are used so that importing
+# this module (e.g. for the model registry) stays cheap
+if TYPE_CHECKING:
+    import torch
 
 _logger = logging.getLogger(__name__)
 
+# Default location for cached vision encoder outputs
+_IMAGE_CACHE_DIR = "~/.cache/qllama/smolvlm_img"
+
+# Default upper bound on the total size of the cached encoder outputs
+_IMAGE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Image.info key under which an image's pixel digest is memoized
+_DIGEST_INFO_KEY = "qllama_digest"
+
+def _image_digest(image: Any) -> str:
+    """Hash an image's pixels, once per image object.
+    
+    Loaded images are reused across turns (see ``load_image``), so history
+    images are not hashed again. Images must not be modified in place after
+    they have been hashed.
+    
+    Args:
+        image: A PIL Image
+        
+    Returns:
+        A hex digest of the image mode, size and pixels
+    """
+    digest = image.info.get(_DIGEST_INFO_KEY)
+    if digest is None:
+        hasher = hashlib.blake2b(f"{image.mode}:{image.size}".encode(), digest_size=16)
+        hasher.update(image.tobytes())
+        digest = hasher.hexdigest()
+        image.info[_DIGEST_INFO_KEY] = digest
+    return digest
+
+def _resolve_item(item: Any, images_by_url: Dict[str, Any], frames_by_path: Dict[str, List[Any]]) -> Any:
+    """Get a content item with its image or video attachment loaded.
+    
+    Args:
+        item: A message content item
+        images_by_url: Loaded images keyed by their URL or path
+        frames_by_path: Loaded video frames keyed by their path
+        
+    Returns:
+        A new dict with the attachment in place of its URL/path, or the item unchanged
+    """
+    if not isinstance(item, dict):
+        return item
+    if item.get("type") == "image" and "url" in item:
+        resolved = {key: value for key, value in item.items() if key != "url"}
+        resolved["image"] = images_by_url[item["url"]]
+        return resolved
+    if item.get("type") == "video" and "path" in item:
+        resolved = {key: value for key, value in item.items() if key != "path"}
+        resolved["frames"] = frames_by_path[item["path"]]
+        return resolved
+    return item
+
+# Result of the PIL import probe, shared by all handler instances
+_PIL_OK: Optional[bool] = None
+_PIL_ERROR = "PIL is not properly installed. Try 'pip uninstall -y pillow && pip install --no-cache-dir pillow'"
+
+def _check_pil() -> None:
+    """Make sure PIL imports cleanly, probing only once per process."""
+    global _PIL_OK
+    if _PIL_OK:
+        return
+    if _PIL_OK is False:
+        raise ImportError(_PIL_ERROR)
+    
+    try:
+        from PIL import Image
+    except ImportError as e:
+        _PIL_OK = False
+        if "_imaging" in str(e):
+            _logger.error("PIL is not properly installed. This is usually caused by missing dependencies.")
+            _logger.error("Try reinstalling pillow with: pip uninstall -y pillow && pip install --no-cache-dir pillow")
+            raise ImportError(_PIL_ERROR) from e
+        raise
+    _PIL_OK = True
+
 class SmolVLMHandler(BaseModelHandler):
     """Handler for SmolVLM2 model."""
     
@@ -21,27 +101,30 @@ class SmolVLMHandler(BaseModelHandler):
         
         Args:
             model_name: The name or path of the SmolVLM model
-            **kwargs: Additional model-specific arguments
+            **kwargs: Additional model-specific arguments. ``cache_image_features``
+                (default True) keeps vision encoder outputs per image under
+                ``image_cache_dir``, bounded by ``image_cache_max_bytes``.
         """
         if "HuggingFaceTB/SmolVLM" not in model_name:
             model_name = "HuggingFaceTB/SmolVLM2-2.2B-Instruct"
         
+        import torch
+        
         super().__init__(model_name=model_name, **kwargs)
         self.torch_dtype = kwargs.get("torch_dtype", torch.bfloat16)
         self.attn_implementation = kwargs.get("attn_implementation", "flash_attention_2")
+        # Vision encoder outputs are cached on disk per image, keyed by image content
+        self.cache_image_features = kwargs.get("cache_image_features", True)
+        self._emb_cache_dir = Path(kwargs.get("image_cache_dir", _IMAGE_CACHE_DIR)).expanduser()
+        self._emb_cache_max_bytes = kwargs.get("image_cache_max_bytes", _IMAGE_CACHE_MAX_BYTES)
         
         # Check if PIL is properly installed
-        try:
-            from PIL import Image
-        except ImportError as e:
-            if "_imaging" in str(e):
-                _logger.error("PIL is not properly installed. This is usually caused by missing dependencies.")
-                _logger.error("Try reinstalling pillow with: pip uninstall -y pillow && pip install --no-cache-dir pillow")
-                raise ImportError("PIL is not properly installed. Try 'pip uninstall -y pillow && pip install --no-cache-dir pillow'") from e
-            raise
+        _check_pil()
         
     def load_model(self) -> None:
         """Load the SmolVLM model and processor."""
+        from transformers import AutoProcessor, AutoModelForImageTextToText
+        
         _logger.info(f"Loading SmolVLM model: {self.model_name}")
         
         try:
@@ -56,7 +139,17 @@ class SmolVLMHandler(BaseModelHandler):
             _logger.error(f"Failed to load SmolVLM model: {e}")
             raise
     
-    def process_messages(self, messages: List[Dict[str, Any]]) -> Dict[str, torch.Tensor]:
+    def _attachment_image_size(self) -> Optional[Tuple[int, int]]:
+        """Get the bound the processor resizes images to, so loads can shrink them once.
+        
+        Returns:
+            A (width, height) bound, or None if the processor doesn't define one
+        """
+        size = getattr(getattr(self.processor, "image_processor", None), "size", None)
+        longest_edge = size.get("longest_edge") if isinstance(size, dict) else None
+        return (longest_edge, longest_edge) if longest_edge else None
+    
+    def process_messages(self, messages: List[Dict[str, Any]]) -> Dict[str, "torch.Tensor"]:
         """Process messages for SmolVLM.
         
         Args:
@@ -65,46 +158,192 @@ class SmolVLMHandler(BaseModelHandler):
         Returns:
             Processed inputs ready for the model
         """
-        # Process images and videos in the messages
-        for message in messages:
-            if "content" in message and isinstance(message["content"], list):
-                for i, content_item in enumerate(message["content"]):
-                    if isinstance(content_item, dict):
-                        # Handle image URLs or paths
-                        if content_item.get("type") == "image" and "url" in content_item:
-                            image = load_image(content_item["url"])
-                            message["content"][i]["image"] = image
-                            # Keep the URL for reference but remove it from processing
-                            if "url" in content_item:
-                                content_item.pop("url")
-                        
-                        # Handle video paths
-                        elif content_item.get("type") == "video" and "path" in content_item:
-                            video_frames = load_video(content_item["path"])
-                            message["content"][i]["frames"] = video_frames
-                            if "path" in content_item:
-                                content_item.pop("path")
-        
-        # Apply chat template and tokenize
-        inputs = self.processor.apply_chat_template(
-            messages,
-            add_generation_prompt=True,
-            tokenize=True,
-            return_dict=True,
-            return_tensors="pt",
-        ).to(self.model.device, dtype=self.torch_dtype)
+        items = [
+            item
+            for message in messages
+            if isinstance(message.get("content"), list)
+            for item in message["content"]
+            if isinstance(item, dict)
+        ]
+        has_video = any(item.get("type") == "video" for item in items)
+        
+        images_by_url, frames_by_path = load_attachments(items, image_size=self._attachment_image_size())
+        
+        # Build new content lists so caller-owned dicts (e.g. the terminal history)
+        # keep their URLs and paths
+        resolved_messages = [
+            {
+                **message,
+                "content": [_resolve_item(item, images_by_url, frames_by_path) for item in message["content"]],
+            }
+            if isinstance(message.get("content"), list) else message
+            for message in messages
+        ]
+        
+        # All images in prompt order, including ones the caller passed pre-loaded
+        images = [
+            item["image"]
+            for message in resolved_messages
+            if isinstance(message.get("content"), list)
+            for item in message["content"]
+            if isinstance(item, dict) and item.get("type") == "image" and "image" in item
+        ]
+        
+        if has_video:
+            # Video frames are expanded by the processor's own chat template handling
+            inputs = self.processor.apply_chat_template(
+                resolved_messages,
+                add_generation_prompt=True,
+                tokenize=True,
+                return_dict=True,
+                return_tensors="pt",
+            )
+        else:
+            # Render the prompt with bare image placeholders, then preprocess all
+            # images in a single processor call
+            placeholder_messages = [
+                {
+                    **message,
+                    "content": [
+                        {"type": "image"} if isinstance(item, dict) and item.get("type") == "image" else item
+                        for item in message["content"]
+                    ],
+                }
+                if isinstance(message.get("content"), list) else message
+                for message in resolved_messages
+            ]
+            prompt = self.processor.apply_chat_template(
+                placeholder_messages,
+                add_generation_prompt=True,
+                tokenize=False,
+            )
+            inputs = self.processor(
+                text=prompt,
+                images=images or None,
+                return_tensors="pt",
+            )
+        inputs = self._move_inputs(inputs, self.model.device, dtype=self.torch_dtype)
+        
+        # Swap pixel values for cached encoder outputs (video frames are not cached)
+        if self.cache_image_features and images and not has_video and "pixel_values" in inputs:
+            self._use_cached_image_features(inputs, images)
         
         return inputs
     
-    def generate(self, messages: List[Dict[str, Any]], **kwargs) -> str:
+    def _feature_cache_path(self, image: Any) -> Path:
+        """Get the cache file for an image's encoder output under this model."""
+        key = hashlib.blake2b(f"{self.model_name}:{_image_digest(image)}".encode(), digest_size=16)
+        return self._emb_cache_dir / f"{key.hexdigest()}.npy"
+    
+    def _encode_image(self, image: Any) -> "torch.Tensor":
+        """Run the vision encoder on a single image.
+        
+        Images are preprocessed and encoded independently, so concatenating the
+        outputs of several images matches encoding them in one processor call.
+        
+        Args:
+            image: A PIL Image
+            
+        Returns:
+            The image hidden states, one row block per image tile
+        """
+        import torch
+        
+        pixel_inputs = self.processor.image_processor(images=[[image]], return_tensors="pt")
+        pixel_inputs = self._move_inputs(pixel_inputs, self.model.device, dtype=self.torch_dtype)
+        with torch.inference_mode():
+            return self.model.get_image_features(
+                pixel_values=pixel_inputs["pixel_values"],
+                pixel_attention_mask=pixel_inputs.get("pixel_attention_mask"),
+            )
+    
+    def _cached_image_features(self, image: Any) -> "torch.Tensor":
+        """Get an image's encoder output from the disk cache, encoding it on a miss.
+        
+        Args:
+            image: A PIL Image
+            
+        Returns:
+            The image hidden states on the model device
+        """
+        import numpy as np
+        import torch
+        
+        cache_path = self._feature_cache_path(image)
+        if cache_path.is_file():
+            _logger.debug(f"Loading cached image features from {cache_path}")
+            features = torch.from_numpy(np.load(cache_path))
+            # Bump the modification time so pruning evicts least recently used entries
+            os.utime(cache_path)
+            return features.to(self.model.device, dtype=self.torch_dtype)
+        
+        features = self._encode_image(image)
+        
+        # numpy has no bfloat16, so features are stored as float32
+        self._emb_cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            np.save(f, features.float().cpu().numpy())
+            f.flush()
+        os.replace(tmp_path, cache_path)
+        _logger.debug(f"Cached image features to {cache_path}")
+        self._prune_feature_cache()
+        
+        return features
+    
+    def _prune_feature_cache(self) -> None:
+        """Delete the least recently used cache files until the cache fits its size bound."""
+        entries = []
+        for path in self._emb_cache_dir.glob("*.npy"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+            if total <= self._emb_cache_max_bytes:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            total -= size
+    
+    def _use_cached_image_features(self, inputs: Dict[str, "torch.Tensor"], images: List[Any]) -> None:
+        """Replace ``pixel_values`` in inputs with (possibly cached) image hidden states.
+        
+        The processor still needs the images to lay out the image tokens in the
+        prompt, but the vision encoder only runs for images not seen before, so
+        adding an image to a conversation doesn't re-encode the earlier ones.
+        
+        Args:
+            inputs: Processed inputs, modified in place
+            images: The images that produced ``inputs["pixel_values"]``, in order
+        """
+        import torch
+        
+        try:
+            features = [self._cached_image_features(image) for image in images]
+        except (AttributeError, OSError, ValueError) as e:
+            _logger.warning(f"Image feature cache unavailable, running the vision encoder: {e}")
+            return
+        
+        inputs["image_hidden_states"] = torch.cat(features)
+        inputs.pop("pixel_values", None)
+        inputs.pop("pixel_attention_mask", None)
+    
+    def generate(self, messages: List[Dict[str, Any]], **kwargs) -> Union[str, Iterator[str]]:
         """Generate a response from the SmolVLM model.
         
         Args:
             messages: A list of message dictionaries
-            **kwargs: Additional generation parameters
+            **kwargs: Additional generation parameters; ``stream=True`` returns
+                an iterator over text chunks
             
         Returns:
-            The generated text response
+            The generated text response, or an iterator of text chunks when streaming
         """
         if self.model is None:
             self.load_model()
@@ -121,12 +360,29 @@ class SmolVLMHandler(BaseModelHandler):
         
         _logger.debug(f"Generating with parameters: {generation_kwargs}")
         
+        if kwargs.get("stream"):
+            from transformers import TextIteratorStreamer
+            
+            streamer = TextIteratorStreamer(
+                self.processor.tokenizer, skip_prompt=True, skip_special_tokens=True
+            )
+            return self._stream_generation(
+                lambda stop_event: self.model.generate(
+                    **inputs,
+                    **generation_kwargs,
+                    streamer=streamer,
+                    stopping_criteria=self._stopping_criteria(stop_event),
+                ),
+                streamer,
+            )
+        
         # Generate text
         generated_ids = self.model.generate(**inputs, **generation_kwargs)
         
-        # Decode the generated ids
+        # Decode only the newly generated ids
+        prompt_len = inputs["input_ids"].shape[1]
         generated_texts = self.processor.batch_decode(
-            generated_ids,
+            generated_ids[:, prompt_len:],
             skip_special_tokens=True,
         )
         
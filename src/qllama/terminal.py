@@ -1,18 +1,184 @@
 """Terminal interface for qllama."""
 
+import collections
 import logging
 import os
 import sys
 import re
+import select
 from typing import Dict, List, Any, Optional, Tuple
 import readline
 import shlex
 
-from qllama.models import get_model_handler
 from qllama.deps import check_and_report
 
 _logger = logging.getLogger(__name__)
 
+# Matches <image:...> and <video:...> attachment tags in user input
+_ATTACHMENT_RE = re.compile(r'<(?:image|video):([^>]+)>')
+
+# Attachment kind for each file extension recognized in attachment tags
+_EXT_KIND = {
+    '.jpg': 'image', '.jpeg': 'image', '.png': 'image', '.gif': 'image', '.bmp': 'image', '.webp': 'image',
+    '.mp4': 'video', '.avi': 'video', '.mov': 'video', '.mkv': 'video', '.webm': 'video',
+}
+
+# Inputs that end the chat session
+_EXIT_WORDS = frozenset(("exit", "quit", "/exit", "/quit"))
+
+# Upper bound on prompts answered by one batched generate call
+_MAX_BATCH_SIZE = 4
+
+# Bytes read from piped stdin at a time
+_PIPE_READ_SIZE = 64 * 1024
+
+# Turns between full history rewrites when readline can't append entries
+_HISTORY_FLUSH_INTERVAL = 10
+
+# Default number of readline history entries kept (override with QLLAMA_HISTORY_SIZE)
+_DEFAULT_HISTORY_SIZE = 1000
+
+# History files larger than this are trimmed before readline loads them
+_HISTORY_TRIM_BYTES = 256 * 1024
+
+# First line of history files written by libedit's readline emulation
+_LIBEDIT_HISTORY_HEADER = "_HiStOrY_V2_"
+
+def _history_size() -> int:
+    """Get the maximum number of readline history entries to keep."""
+    value = os.environ.get("QLLAMA_HISTORY_SIZE", "")
+    if not value:
+        return _DEFAULT_HISTORY_SIZE
+    try:
+        size = int(value)
+    except ValueError:
+        size = 0
+    if size < 1:
+        # Values below 1 would make readline keep nothing (or everything) and trimming empty the file
+        _logger.warning(f"Ignoring invalid QLLAMA_HISTORY_SIZE: {value}")
+        return _DEFAULT_HISTORY_SIZE
+    return size
+
+def _trim_history_file(histfile: str, max_lines: int) -> None:
+    """Keep only the last max_lines entries of a large history file.
+    
+    Args:
+        histfile: Path to the readline history file
+        max_lines: Number of trailing lines to keep
+    """
+    if os.path.getsize(histfile) <= _HISTORY_TRIM_BYTES:
+        return
+    
+    with open(histfile, "r", encoding="utf-8", errors="replace") as f:
+        first_line = f.readline()
+        tail = collections.deque(f, maxlen=max_lines)
+    
+    # libedit refuses to read a history file without its header line
+    if first_line.startswith(_LIBEDIT_HISTORY_HEADER):
+        header = [first_line]
+    else:
+        header = []
+        if len(tail) < max_lines:
+            tail.appendleft(first_line)
+    
+    tmp_path = f"{histfile}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.writelines(header)
+            f.writelines(tail)
+        os.replace(tmp_path, histfile)
+    except OSError:
+        # Don't leave a partial copy behind (e.g. when the disk is full)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+class _PipedInput:
+    """Line reader for piped stdin that can tell which lines are already waiting.
+    
+    ``input()`` reads ahead into ``sys.stdin``'s buffer, where ``select`` can't
+    see it, so piped input is read from the raw file descriptor instead and
+    every line goes through the same buffer.
+    """
+    
+    def __init__(self, fd: int, encoding: Optional[str] = None):
+        """Initialize the reader.
+        
+        Args:
+            fd: File descriptor to read from
+            encoding: Text encoding of the input (UTF-8 if not given)
+        """
+        self.fd = fd
+        self.encoding = encoding or "utf-8"
+        self._buffer = b""
+        self._eof = False
+    
+    def _fill(self) -> None:
+        """Read whatever is available from the descriptor into the buffer."""
+        chunk = os.read(self.fd, _PIPE_READ_SIZE)
+        if chunk:
+            self._buffer += chunk
+        else:
+            self._eof = True
+    
+    def _has_line(self) -> bool:
+        """Check whether a complete line (or the unterminated last one) is buffered."""
+        return b"\n" in self._buffer or (self._eof and bool(self._buffer))
+    
+    def _ready(self) -> bool:
+        """Check, without blocking, whether more input is waiting on the descriptor."""
+        try:
+            ready, _, _ = select.select([self.fd], [], [], 0)
+        except (OSError, ValueError):
+            # Pipes can't be polled on every platform (e.g. Windows)
+            return False
+        return bool(ready)
+    
+    def readline(self) -> str:
+        """Read the next line, waiting for it if necessary.
+        
+        Returns:
+            The line without its line ending
+            
+        Raises:
+            EOFError: If the input has ended
+        """
+        while not self._has_line() and not self._eof:
+            self._fill()
+        if not self._buffer:
+            raise EOFError
+        line, _, self._buffer = self._buffer.partition(b"\n")
+        return line.decode(self.encoding, errors="replace").rstrip("\r")
+    
+    def queued_lines(self, limit: int) -> List[str]:
+        """Read up to limit further non-empty lines that are already waiting.
+        
+        Args:
+            limit: Maximum number of lines to read
+            
+        Returns:
+            The lines read, without blocking for more input
+        """
+        lines = []
+        while len(lines) < limit:
+            if not self._has_line():
+                if self._eof or not self._ready():
+                    break
+                self._fill()
+                continue
+            line = self.readline()
+            if line.strip():
+                lines.append(line)
+        return lines
+
+def _piped_input() -> Optional[_PipedInput]:
+    """Get a reader for stdin when it is a pipe or file, or None to fall back to input()."""
+    try:
+        return _PipedInput(sys.stdin.fileno(), getattr(sys.stdin, "encoding", None))
+    except (AttributeError, OSError, ValueError):
+        # Replaced stdin without a real descriptor (e.g. io.StringIO)
+        return None
+
 class QllamaTerminal:
     """Terminal interface for qllama."""
     
@@ -22,6 +188,8 @@ class QllamaTerminal:
         device: str = "cuda",
         temperature: float = 1.0,
         max_tokens: int = 64,
+        max_history_turns: int = 16,
+        batch_size: int = 1,
     ):
         """Initialize the QllamaTerminal.
         
@@ -30,6 +198,9 @@ class QllamaTerminal:
             device: The device to run the model on
             temperature: Temperature for generation
             max_tokens: Maximum tokens to generate
+            max_history_turns: Number of past exchanges kept as context
+            batch_size: Maximum number of already-queued prompts answered
+                together (1 disables batching)
         """
         # Check dependencies first
         if not check_and_report():
@@ -39,15 +210,19 @@ class QllamaTerminal:
         self.device = device
         self.temperature = temperature
         self.max_tokens = max_tokens
+        self.batch_size = max(1, min(batch_size, _MAX_BATCH_SIZE))
         
-        # History of user inputs and model responses
-        self.history = []
-        
-        # Pattern to match image or video attachments
-        self.attachment_pattern = re.compile(r'<(?:image|video):([^>]+)>')
+        # History of user inputs and model responses, two entries per turn
+        self.max_history_turns = max(0, max_history_turns)
+        self.history = collections.deque(maxlen=self.max_history_turns * 2)
+        # Prompts not yet written to the readline history file
+        self._unsaved_history = 0
         
         print(f"Initializing qllama with model: {model_name}")
         try:
+            # Imported here so that loading the terminal module (e.g. for --help) stays cheap
+            from qllama.models import get_model_handler
+            
             self.model_handler = get_model_handler(
                 model_name=model_name,
                 device=device,
@@ -70,34 +245,34 @@ class QllamaTerminal:
             A tuple of (formatted messages, continue_flag)
         """
         # Check for exit command
-        if user_input.strip().lower() in ("exit", "quit", "/exit", "/quit"):
+        if user_input.strip().lower() in _EXIT_WORDS:
             return [], False
         
         # Extract attachments (images and videos)
         content = []
-        text = user_input
-        
-        # Find all attachment tags
-        attachments = self.attachment_pattern.findall(text)
-        
-        # If attachments are found, convert them to content items
-        if attachments:
-            # Replace attachment tags with placeholders
-            for attachment_path in attachments:
-                # Determine if it's an image or video based on extension
-                ext = os.path.splitext(attachment_path)[1].lower()
-                if ext in ('.jpg', '.jpeg', '.png', '.gif', '.bmp'):
-                    content.append({
-                        "type": "image",
-                        "url": attachment_path
-                    })
-                    text = text.replace(f"<image:{attachment_path}>", "")
-                elif ext in ('.mp4', '.avi', '.mov', '.mkv'):
-                    content.append({
-                        "type": "video",
-                        "path": attachment_path
-                    })
-                    text = text.replace(f"<video:{attachment_path}>", "")
+        
+        def collect_attachment(match: "re.Match") -> str:
+            """Turn an attachment tag into a content item and drop it from the text."""
+            attachment_path = match.group(1)
+            # Determine if it's an image or video based on extension
+            kind = _EXT_KIND.get(os.path.splitext(attachment_path)[1].lower())
+            if kind == "image":
+                content.append({
+                    "type": "image",
+                    "url": attachment_path
+                })
+            elif kind == "video":
+                content.append({
+                    "type": "video",
+                    "path": attachment_path
+                })
+            else:
+                # Keep tags with unknown extensions in the text
+                return match.group(0)
+            return ""
+        
+        # Replace all attachment tags in a single pass over the input
+        text = _ATTACHMENT_RE.sub(collect_attachment, user_input)
         
         # Add remaining text if not empty
         text = text.strip()
@@ -111,10 +286,103 @@ class QllamaTerminal:
         messages = [{"role": "user", "content": content}]
         
         # Include history in messages
-        full_messages = self.history + messages
+        full_messages = list(self.history)
+        full_messages.extend(messages)
         
         return full_messages, True
     
+    def _load_history(self, histfile: str) -> None:
+        """Load the readline history file, trimming it first if it has grown large.
+        
+        Args:
+            histfile: Path to the readline history file
+        """
+        history_size = _history_size()
+        readline.set_history_length(history_size)
+        # Trim first so startup time doesn't grow with the size of the file
+        try:
+            _trim_history_file(histfile, history_size)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            # e.g. a read-only home directory or a full disk; load the file untrimmed
+            _logger.warning(f"Could not trim history file: {e}")
+        
+        try:
+            readline.read_history_file(histfile)
+        except FileNotFoundError:
+            # append_history_file only appends to an existing file
+            try:
+                open(histfile, "a").close()
+            except OSError as e:
+                _logger.warning(f"Could not create history file: {e}")
+        except OSError as e:
+            # e.g. a file readline can't parse; start without history rather than crash
+            _logger.warning(f"Could not load history file: {e}")
+    
+    def _save_history_entry(self, histfile: str) -> None:
+        """Append the latest readline entry to the history file.
+        
+        Args:
+            histfile: Path to the readline history file
+        """
+        try:
+            readline.append_history_file(1, histfile)
+        except AttributeError:
+            # Not every readline build has append_history_file; rewrite periodically instead
+            self._unsaved_history += 1
+            if self._unsaved_history >= _HISTORY_FLUSH_INTERVAL:
+                # Retry at the next interval rather than warning on every turn
+                self._unsaved_history = 0
+                try:
+                    readline.write_history_file(histfile)
+                except OSError as e:
+                    _logger.warning(f"Could not save history file: {e}")
+        except OSError as e:
+            _logger.warning(f"Could not save history file: {e}")
+    
+    def _respond_batch(self, user_inputs: List[str]) -> bool:
+        """Answer several queued prompts with one batched generation call.
+        
+        Each prompt is answered against the history as it was before the batch,
+        then all exchanges are appended to the history in input order.
+        
+        Args:
+            user_inputs: The queued user input strings
+            
+        Returns:
+            False if one of the inputs asked to end the session, True otherwise
+        """
+        inputs = []
+        conversations = []
+        keep_running = True
+        for user_input in user_inputs:
+            messages, continue_flag = self.parse_user_input(user_input)
+            if not continue_flag:
+                keep_running = False
+                break
+            inputs.append(user_input)
+            conversations.append(messages)
+        
+        if conversations:
+            responses = self.model_handler.generate_batch(
+                conversations,
+                temperature=self.temperature,
+                max_new_tokens=self.max_tokens,
+            )
+            for index, (user_input, messages, response) in enumerate(zip(inputs, conversations, responses)):
+                # run() already echoed the first prompt; echo the ones read from the queue
+                if index:
+                    print(f"\nUser: {user_input}")
+                print(f"\nqllama: {response}")
+                self.history.append(messages[-1])
+                self.history.append({
+                    "role": "assistant",
+                    "content": [{"type": "text", "text": response}]
+                })
+        
+        return keep_running
+    
     def run(self) -> None:
         """Run the terminal interface."""
         print(f"\nqllama chat with {self.model_name} 🦙")
@@ -123,23 +391,39 @@ class QllamaTerminal:
         print("To include videos: <video:/path/to/video.mp4>")
         print("\n")
         
-        # Setup command history
+        # Setup command history, unless input is piped or scripted
+        interactive = sys.stdin.isatty()
         histfile = os.path.join(os.path.expanduser("~"), ".qllama_history")
-        try:
-            readline.read_history_file(histfile)
-            readline.set_history_length(1000)
-        except FileNotFoundError:
-            pass
+        if interactive:
+            self._load_history(histfile)
+        # Piped input is read directly so that queued prompts can be batched
+        piped = None if interactive else _piped_input()
         
         try:
             while True:
                 try:
-                    user_input = input("\nUser: ")
-                    readline.write_history_file(histfile)
+                    if piped is None:
+                        user_input = input("\nUser: ")
+                    else:
+                        print("\nUser: ", end="", flush=True)
+                        user_input = piped.readline()
+                        # Nothing is echoed when reading from a pipe, so show the prompt
+                        print(user_input)
                     
                     if not user_input.strip():
                         continue
                     
+                    if interactive:
+                        self._save_history_entry(histfile)
+                    
+                    # Coalesce piped prompts that are already queued into one call
+                    queued = piped.queued_lines(self.batch_size - 1) if piped is not None and self.batch_size > 1 else []
+                    if queued:
+                        if not self._respond_batch([user_input] + queued):
+                            print("Exiting qllama. Goodbye!")
+                            break
+                        continue
+                    
                     messages, continue_flag = self.parse_user_input(user_input)
                     
                     if not continue_flag:
@@ -151,13 +435,18 @@ class QllamaTerminal:
                     
                     print("\nqllama: ", end="", flush=True)
                     
-                    response = self.model_handler.generate(
+                    # Print chunks as they are generated rather than waiting for the full reply
+                    parts = []
+                    for chunk in self.model_handler.generate_stream(
                         messages,
                         temperature=self.temperature,
                         max_new_tokens=self.max_tokens,
-                    )
-                    
-                    print(response)
+                    ):
+                        sys.stdout.write(chunk)
+                        sys.stdout.flush()
+                        parts.append(chunk)
+                    print()
+                    response = "".join(parts).strip()
                     
                     # Update history with user input and model response
                     # Extract only the last user message
@@ -168,6 +457,10 @@ class QllamaTerminal:
                         "content": [{"type": "text", "text": response}]
                     })
                     
+                except EOFError:
+                    # End of piped input (or Ctrl-D)
+                    print()
+                    break
                 except KeyboardInterrupt:
                     print("\nOperation interrupted. Type 'exit' to quit.")
                 except Exception as e:
@@ -176,7 +469,8 @@ class QllamaTerminal:
         
         finally:
             # Clean up
-            try:
-                readline.write_history_file(histfile)
-            except Exception as e:
-                _logger.warning(f"Could not save history file: {e}")
+            if interactive:
+                try:
+                    readline.write_history_file(histfile)
+                except Exception as e:
+                    _logger.warning(f"Could not save history file: {e}")
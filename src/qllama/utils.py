@@ -1,15 +1,50 @@
 """Utilities for qllama."""
 
+import io
 import os
 import logging
-import tempfile
-from typing import List, Union, Optional, Any
-from urllib.parse import urlparse
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple, Union, Optional, Any
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from pathlib import Path
 
 _logger = logging.getLogger(__name__)
 
+# Shared HTTP session so repeated downloads reuse pooled keep-alive connections
+_SESSION = requests.Session()
+_ADAPTER = HTTPAdapter(
+    pool_connections=8,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.3),
+)
+_SESSION.mount("http://", _ADAPTER)
+_SESSION.mount("https://", _ADAPTER)
+
+# Schemes treated as remote locations by is_url
+_URL_PREFIXES = ("http://", "https://", "ftp://", "s3://", "gs://")
+
+# (connect, read) seconds to wait for an image server before giving up
+_REQUEST_TIMEOUT = (3.05, 30)
+
+# Bytes read per iteration when downloading images
+_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Upper bound on concurrent attachment loads
+_MAX_LOAD_WORKERS = 8
+
+# Recently loaded images, most recently used last. URL entries keep their
+# ETag/Last-Modified headers so they can be revalidated with a conditional GET.
+# The cache is bounded both by entries and by decoded pixel bytes.
+# Set QLLAMA_DISABLE_IMAGE_CACHE=1 to turn the cache off.
+_IMAGE_CACHE_SIZE = 64
+_IMAGE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+_IMAGE_CACHE: "OrderedDict[Any, Tuple[Any, Dict[str, str]]]" = OrderedDict()
+_IMAGE_CACHE_LOCK = threading.Lock()
+
 # Verify PIL is properly installed at module import time
 try:
     from PIL import Image
@@ -19,6 +54,17 @@ except ImportError as e:
         _logger.error("Try reinstalling pillow with: pip uninstall -y pillow && pip install --no-cache-dir pillow")
     raise
 
+# OpenCV and NumPy are only needed for video input
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 def is_url(path_or_url: str) -> bool:
     """Check if a string is a URL.
     
@@ -28,17 +74,137 @@ def is_url(path_or_url: str) -> bool:
     Returns:
         True if the string is a URL, False otherwise
     """
+    # The longest prefix is 8 characters, so only that much is lowercased
+    return isinstance(path_or_url, str) and path_or_url[:8].lower().startswith(_URL_PREFIXES)
+
+def _image_cache_enabled() -> bool:
+    """Check whether loaded images may be cached."""
+    return not os.environ.get("QLLAMA_DISABLE_IMAGE_CACHE")
+
+def _cache_get(key: Any) -> Optional[Tuple[Any, Dict[str, str]]]:
+    """Get a cached (image, validators) entry and mark it as recently used."""
+    with _IMAGE_CACHE_LOCK:
+        entry = _IMAGE_CACHE.get(key)
+        if entry is not None:
+            _IMAGE_CACHE.move_to_end(key)
+        return entry
+
+def _image_nbytes(image: Any) -> int:
+    """Estimate the memory held by a decoded image's pixels."""
     try:
-        result = urlparse(path_or_url)
-        return all([result.scheme, result.netloc])
-    except ValueError:
-        return False
+        bytes_per_band = 4 if image.mode in ("I", "F") else 1
+        return int(image.width) * int(image.height) * len(image.getbands()) * bytes_per_band
+    except (AttributeError, TypeError, ValueError):
+        return 0
+
+def _cache_put(key: Any, image: Any, validators: Dict[str, str]) -> None:
+    """Cache an image, evicting least recently used entries while over either bound."""
+    if _image_nbytes(image) > _IMAGE_CACHE_MAX_BYTES:
+        # Caching it would only flush everything else
+        return
+    
+    with _IMAGE_CACHE_LOCK:
+        _IMAGE_CACHE[key] = (image, validators)
+        _IMAGE_CACHE.move_to_end(key)
+        total_bytes = sum(_image_nbytes(cached) for cached, _ in _IMAGE_CACHE.values())
+        while len(_IMAGE_CACHE) > _IMAGE_CACHE_SIZE or total_bytes > _IMAGE_CACHE_MAX_BYTES:
+            _, (evicted, _) = _IMAGE_CACHE.popitem(last=False)
+            total_bytes -= _image_nbytes(evicted)
+
+def _prepare_image(image: Any, target_size: Optional[Tuple[int, int]]) -> Any:
+    """Decode an image and shrink it to fit within target_size, if one is given."""
+    image.load()
+    if target_size is None:
+        return image
+    
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    # thumbnail keeps the aspect ratio and never enlarges the image
+    image.thumbnail(target_size, Image.LANCZOS)
+    return image
+
+def _load_image_from_url(url: str, target_size: Optional[Tuple[int, int]] = None) -> Any:
+    """Download an image, revalidating a cached copy instead of refetching it."""
+    use_cache = _image_cache_enabled()
+    key = url if target_size is None else (url, target_size)
+    cached = _cache_get(key) if use_cache else None
+    
+    headers = {}
+    if cached is not None:
+        image, validators = cached
+        if not validators:
+            # Nothing to revalidate with, so trust the cached copy
+            return image
+        if "ETag" in validators:
+            headers["If-None-Match"] = validators["ETag"]
+        if "Last-Modified" in validators:
+            headers["If-Modified-Since"] = validators["Last-Modified"]
+    
+    response = _SESSION.get(url, stream=True, timeout=_REQUEST_TIMEOUT, headers=headers)
+    # Streamed responses only return their connection to the pool once read and closed
+    try:
+        if cached is not None and response.status_code == 304:
+            _logger.debug(f"Cached image is still fresh: {url}")
+            # Consume the (empty) body; closing an unread response drops the connection
+            _ = response.content
+            return cached[0]
+        response.raise_for_status()
+        
+        # Buffer the download in memory; PIL can read from any file-like object
+        buffer = io.BytesIO()
+        for chunk in response.iter_content(chunk_size=_DOWNLOAD_CHUNK_SIZE):
+            buffer.write(chunk)
+        buffer.seek(0)
+    finally:
+        response.close()
+    
+    # Load the image using PIL, decoding now rather than lazily
+    image = _prepare_image(Image.open(buffer), target_size)
+    
+    if use_cache:
+        validators = {
+            name: response.headers[name]
+            for name in ("ETag", "Last-Modified")
+            if name in response.headers
+        }
+        _cache_put(key, image, validators)
+    
+    return image
 
-def load_image(path_or_url: str) -> Any:
+def _load_image_from_path(path: str, target_size: Optional[Tuple[int, int]] = None) -> Any:
+    """Open an image file, reusing the cached copy while the file is unchanged."""
+    # Check if the file exists
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f"Image file not found: {path}")
+    
+    if not _image_cache_enabled():
+        image = Image.open(path)
+        return image if target_size is None else _prepare_image(image, target_size)
+    
+    # Key on the modification time so edited files are loaded again
+    key = (path, os.stat(path).st_mtime_ns, target_size)
+    cached = _cache_get(key)
+    if cached is not None:
+        return cached[0]
+    
+    # Load the image using PIL; decode now so the file handle is released
+    image = _prepare_image(Image.open(path), target_size)
+    _cache_put(key, image, {})
+    
+    return image
+
+def load_image(path_or_url: str, target_size: Optional[Tuple[int, int]] = None) -> Any:
     """Load an image from a path or URL.
     
+    Recently loaded images are kept in a small LRU cache, so attachments that
+    are referenced again in later turns are not downloaded, decoded or resized
+    again. The returned image is shared with the cache and with other callers:
+    copy it (``image.copy()``) before modifying it in place.
+    
     Args:
         path_or_url: Path to an image file or URL
+        target_size: Optional (width, height) bound; the image is converted to
+            RGB and shrunk to fit within it, keeping its aspect ratio
         
     Returns:
         A loaded image object (PIL Image or as required by the model)
@@ -46,36 +212,20 @@ def load_image(path_or_url: str) -> Any:
     try:
         if is_url(path_or_url):
             _logger.debug(f"Loading image from URL: {path_or_url}")
-            response = requests.get(path_or_url, stream=True)
-            response.raise_for_status()
-            
-            # Create a temporary file to save the downloaded image
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as tmp:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        tmp.write(chunk)
-                tmp_path = tmp.name
-            
-            # Load the image using PIL
-            image = Image.open(tmp_path)
-            
-            # Clean up the temporary file
-            os.unlink(tmp_path)
-            
-            return image
+            return _load_image_from_url(path_or_url, target_size)
         else:
             _logger.debug(f"Loading image from path: {path_or_url}")
-            # Check if the file exists
-            if not os.path.isfile(path_or_url):
-                raise FileNotFoundError(f"Image file not found: {path_or_url}")
-            
-            # Load the image using PIL
-            return Image.open(path_or_url)
+            return _load_image_from_path(path_or_url, target_size)
         
     except Exception as e:
         _logger.error(f"Error loading image from {path_or_url}: {e}")
         raise
 
+def _frame_to_image(frame: Any) -> Any:
+    """Convert a BGR OpenCV frame to an RGB PIL Image."""
+    # Reverse the channel axis instead of a cvtColor pass (one contiguous copy)
+    return Image.fromarray(np.ascontiguousarray(frame[:, :, ::-1]))
+
 def load_video(path: str, max_frames: int = 8) -> List[Any]:
     """Load video frames from a path.
     
@@ -87,9 +237,8 @@ def load_video(path: str, max_frames: int = 8) -> List[Any]:
         A list of frames as PIL Images
     """
     try:
-        import cv2
-        from PIL import Image
-        import numpy as np
+        if cv2 is None or np is None:
+            raise ImportError("Loading videos requires OpenCV and NumPy: pip install opencv-python")
         
         _logger.debug(f"Loading video from path: {path}")
         
@@ -100,7 +249,6 @@ def load_video(path: str, max_frames: int = 8) -> List[Any]:
         # Open the video file
         video = cv2.VideoCapture(path)
         
-        frames = []
         total_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
         
         if total_frames <= 0:
@@ -108,19 +256,28 @@ def load_video(path: str, max_frames: int = 8) -> List[Any]:
         
         # Calculate frame indices to extract (evenly distributed)
         indices = np.linspace(0, total_frames - 1, min(max_frames, total_frames), dtype=int)
+        wanted = set(int(i) for i in indices)
         
-        for i in indices:
-            video.set(cv2.CAP_PROP_POS_FRAMES, i)
-            ret, frame = video.read()
+        # Read the video sequentially: seeking with CAP_PROP_POS_FRAMES decodes again
+        # from the previous keyframe for every sample, while grab() just advances and
+        # only the sampled frames are retrieved
+        raw_frames = []
+        for i in range(max(wanted) + 1):
+            if not video.grab():
+                break
+            if i not in wanted:
+                continue
+            
+            ret, frame = video.retrieve()
             
             if ret:
-                # Convert BGR to RGB
-                frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                pil_image = Image.fromarray(frame_rgb)
-                frames.append(pil_image)
+                raw_frames.append(frame)
         
         video.release()
         
+        # Color conversion releases the GIL, so the sampled frames are converted in parallel
+        frames = _map_concurrently(_frame_to_image, raw_frames)
+        
         if not frames:
             raise ValueError(f"Failed to extract frames from video: {path}")
         
@@ -129,3 +286,40 @@ def load_video(path: str, max_frames: int = 8) -> List[Any]:
     except Exception as e:
         _logger.error(f"Error loading video from {path}: {e}")
         raise
+
+def _map_concurrently(func: Callable[[Any], Any], args: List[Any]) -> List[Any]:
+    """Apply func to each argument on a thread pool, preserving order."""
+    if len(args) <= 1:
+        return [func(arg) for arg in args]
+    with ThreadPoolExecutor(max_workers=min(_MAX_LOAD_WORKERS, len(args))) as executor:
+        return list(executor.map(func, args))
+
+def load_attachments(
+    items: List[Dict[str, Any]],
+    image_size: Optional[Tuple[int, int]] = None,
+) -> Tuple[Dict[str, Any], Dict[str, List[Any]]]:
+    """Load the image and video attachments of message content items concurrently.
+    
+    Downloads and decodes are mostly I/O bound, so all attachments of a prompt
+    are loaded together on a thread pool and each distinct URL/path only once.
+    
+    Args:
+        items: Message content items; ``{"type": "image", "url": ...}`` and
+            ``{"type": "video", "path": ...}`` items are loaded, others ignored
+        image_size: Optional bound passed to ``load_image`` as ``target_size``
+        
+    Returns:
+        A tuple of (images keyed by URL/path, video frames keyed by path)
+    """
+    urls = list(dict.fromkeys(
+        item["url"] for item in items if item.get("type") == "image" and "url" in item
+    ))
+    paths = list(dict.fromkeys(
+        item["path"] for item in items if item.get("type") == "video" and "path" in item
+    ))
+    
+    calls = [(lambda url: load_image(url, target_size=image_size), url) for url in urls]
+    calls += [(load_video, path) for path in paths]
+    results = _map_concurrently(lambda call: call[0](call[1]), calls)
+    
+    return dict(zip(urls, results[:len(urls)])), dict(zip(paths, results[len(urls):]))
@@ -14,6 +14,21 @@ def test_parse_args():
     args = parse_args(["list"])
     assert args.command == "list"
 
+def test_parse_args_model_choices():
+    """Test that model names are normalized and unknown models rejected."""
+    args = parse_args(["run", "SmolVLM2-2.2B"])
+    assert args.model == "smolvlm2"
+    
+    with pytest.raises(SystemExit):
+        parse_args(["run", "non_existent_model"])
+
+def test_parse_args_max_history_turns():
+    """Test that negative history lengths are rejected."""
+    assert parse_args(["run", "mistral", "--max-history-turns", "0"]).max_history_turns == 0
+    
+    with pytest.raises(SystemExit):
+        parse_args(["run", "mistral", "--max-history-turns", "-1"])
+
 @patch("qllama.cli.QllamaTerminal")
 def test_main_run(mock_terminal):
     """Test main function with run command."""
@@ -26,6 +41,8 @@ def test_main_run(mock_terminal):
         device="cuda",
         temperature=1.0,
         max_tokens=64,
+        max_history_turns=16,
+        batch_size=1,
     )
     mock_terminal_instance.run.assert_called_once()
 
@@ -3,9 +3,16 @@
 import pytest
 from unittest.mock import MagicMock, patch
 
-from qllama.models import get_model_handler
+from qllama.models import get_model_handler, _HANDLER_CACHE
 from qllama.models.base import BaseModelHandler
 
+@pytest.fixture(autouse=True)
+def clear_handler_cache():
+    """Make sure every test resolves handler classes from scratch."""
+    _HANDLER_CACHE.clear()
+    yield
+    _HANDLER_CACHE.clear()
+
 def test_get_model_handler():
     """Test the get_model_handler function."""
     with pytest.raises(ValueError):
@@ -21,6 +28,19 @@ def test_get_model_handler():
         assert handler is mock_handler.return_value
         mock_handler.assert_called_once()
 
+def test_get_model_handler_caches_class():
+    """Test that handler classes are only resolved once."""
+    with patch("qllama.models.import_module") as mock_import:
+        mock_module = MagicMock()
+        mock_handler = MagicMock(spec=BaseModelHandler)
+        mock_module.SmolVLMHandler = mock_handler
+        mock_import.return_value = mock_module
+        
+        get_model_handler("smolvlm2")
+        get_model_handler("SmolVLM2")
+        mock_import.assert_called_once()
+        assert mock_handler.call_count == 2
+
 @pytest.mark.parametrize(
     "model_name", 
     ["smolvlm2", "SmolVLM2", "smol-vlm2", "SmolVLM2-2.2B"]
@@ -36,3 +56,255 @@ def test_model_name_normalization(model_name):
         get_model_handler(model_name)
         # The model name is normalized correctly if we get here without errors
         assert True
+
+class _FakeStreamer:
+    """Minimal stand-in for transformers.TextIteratorStreamer."""
+    
+    def __init__(self):
+        import queue
+        self.queue = queue.Queue()
+    
+    def put(self, text):
+        self.queue.put(text)
+    
+    def end(self):
+        self.queue.put(None)
+    
+    def __iter__(self):
+        while (text := self.queue.get()) is not None:
+            yield text
+
+def test_stream_generation():
+    """Test that streamed chunks come from the background generation."""
+    streamer = _FakeStreamer()
+    
+    def generate_fn(stop_event):
+        for text in ("Hello", ", ", "world"):
+            streamer.put(text)
+        streamer.end()
+    
+    chunks = BaseModelHandler._stream_generation(generate_fn, streamer)
+    assert list(chunks) == ["Hello", ", ", "world"]
+
+def test_stream_generation_error():
+    """Test that generation errors are raised to the consumer."""
+    streamer = _FakeStreamer()
+    
+    def generate_fn(stop_event):
+        raise RuntimeError("boom")
+    
+    with pytest.raises(RuntimeError, match="boom"):
+        list(BaseModelHandler._stream_generation(generate_fn, streamer))
+
+def test_stream_generation_interrupt_stops_generation():
+    """Test that interrupting the consumer stops generation instead of waiting for it."""
+    import time
+    
+    streamer = _FakeStreamer()
+    produced = []
+    
+    def generate_fn(stop_event):
+        # Would run for ~5s unless asked to stop
+        for i in range(500):
+            if stop_event.is_set():
+                break
+            produced.append(i)
+            streamer.put(str(i))
+            time.sleep(0.01)
+        streamer.end()
+    
+    chunks = BaseModelHandler._stream_generation(generate_fn, streamer)
+    assert next(chunks) == "0"
+    
+    start = time.monotonic()
+    with pytest.raises(KeyboardInterrupt):
+        chunks.throw(KeyboardInterrupt)
+    
+    assert time.monotonic() - start < 1.0
+    assert len(produced) < 500
+
+def test_model_alias():
+    """Test that model aliases resolve to the registered handler."""
+    with patch("qllama.models.import_module") as mock_import:
+        mock_module = MagicMock()
+        mock_handler = MagicMock(spec=BaseModelHandler)
+        mock_module.MistralHandler = mock_handler
+        mock_import.return_value = mock_module
+        
+        get_model_handler("Mistral-7B-Instruct")
+        mock_import.assert_called_once_with("qllama.models.text.mistral")
+        mock_handler.assert_called_once()
+
+def test_smolvlm_process_messages_keeps_caller_messages():
+    """Test that SmolVLM preprocessing loads images without mutating the input."""
+    from qllama.models.vision import smolvlm
+    
+    handler = object.__new__(smolvlm.SmolVLMHandler)
+    handler.processor = MagicMock()
+    handler.model = MagicMock()
+    handler.torch_dtype = None
+    handler.cache_image_features = False
+    handler._move_inputs = lambda inputs, device, dtype=None: inputs
+    
+    messages = [{
+        "role": "user",
+        "content": [
+            {"type": "text", "text": "Compare these"},
+            {"type": "image", "url": "a.jpg"},
+            {"type": "image", "url": "b.jpg"},
+            {"type": "image", "url": "a.jpg"},
+        ],
+    }]
+    
+    with patch("qllama.utils.load_image", side_effect=lambda url, target_size=None: f"image:{url}") as mock_load:
+        handler.process_messages(messages)
+    
+    assert mock_load.call_count == 2
+    assert messages[0]["content"][1] == {"type": "image", "url": "a.jpg"}
+    prompt_messages = handler.processor.apply_chat_template.call_args[0][0]
+    assert prompt_messages[0]["content"][1] == {"type": "image"}
+    assert handler.processor.call_args[1]["images"] == ["image:a.jpg", "image:b.jpg", "image:a.jpg"]
+
+def test_generate_stream_fallback():
+    """Test that handlers returning a full response stream it as one chunk."""
+    class FullResponseHandler(BaseModelHandler):
+        def load_model(self):
+            pass
+        
+        def generate(self, messages, **kwargs):
+            return "full response"
+    
+    handler = FullResponseHandler(model_name="test", device="cpu")
+    assert list(handler.generate_stream([])) == ["full response"]
+
+def test_generate_batch_fallback():
+    """Test that handlers without batching answer each conversation in turn."""
+    class EchoHandler(BaseModelHandler):
+        def load_model(self):
+            pass
+        
+        def generate(self, messages, **kwargs):
+            assert "stream" not in kwargs
+            return messages[-1]["content"]
+    
+    handler = EchoHandler(model_name="test", device="cpu")
+    conversations = [[{"role": "user", "content": "a"}], [{"role": "user", "content": "b"}]]
+    assert handler.generate_batch(conversations, stream=True) == ["a", "b"]
+
+
+class _FakeKVCache:
+    """Stand-in for a ``DynamicCache`` that only tracks its length."""
+    
+    def __init__(self, seq_length):
+        self.seq_length = seq_length
+    
+    def get_seq_length(self):
+        return self.seq_length
+    
+    def crop(self, max_length):
+        self.seq_length = max_length
+
+def _mistral_handler_with_cache(cached_ids):
+    """Build a Mistral handler holding a previous turn's cache, without loading a model."""
+    torch = pytest.importorskip("torch")
+    pytest.importorskip("transformers")
+    from qllama.models.text.mistral import MistralHandler
+    
+    handler = object.__new__(MistralHandler)
+    handler._kv_cache = _FakeKVCache(len(cached_ids))
+    handler._cached_input_ids = torch.tensor(cached_ids)
+    return handler, torch
+
+def test_reusable_kv_cache_shared_prefix():
+    """Test that the cache is cropped to the prefix shared with the new prompt."""
+    handler, torch = _mistral_handler_with_cache([1, 2, 3, 4, 5])
+    
+    cache = handler._reusable_kv_cache(torch.tensor([[1, 2, 3, 9, 9, 9]]))
+    
+    assert cache is handler._kv_cache
+    assert cache.get_seq_length() == 3
+
+def test_reusable_kv_cache_keeps_one_token_to_prefill():
+    """Test that a repeated prompt still leaves its last token uncached."""
+    handler, torch = _mistral_handler_with_cache([1, 2, 3, 4])
+    
+    cache = handler._reusable_kv_cache(torch.tensor([[1, 2, 3, 4]]))
+    
+    assert cache.get_seq_length() == 3
+
+def test_reusable_kv_cache_no_shared_prefix():
+    """Test that a prompt diverging at the first token gets a fresh cache."""
+    handler, torch = _mistral_handler_with_cache([1, 2, 3])
+    previous = handler._kv_cache
+    
+    cache = handler._reusable_kv_cache(torch.tensor([[7, 2, 3, 4]]))
+    
+    assert cache is not previous
+    assert cache.get_seq_length() == 0
+
+def test_run_generate_failure_drops_kv_cache():
+    """Test that a failed generate call doesn't leave a stale cache behind."""
+    handler, torch = _mistral_handler_with_cache([1, 2, 3])
+    handler.reuse_kv_cache = True
+    handler.model = MagicMock()
+    handler.model.generate.side_effect = RuntimeError("out of memory")
+    
+    with pytest.raises(RuntimeError):
+        handler._run_generate({"input_ids": torch.tensor([[1, 2, 3, 4]])}, MagicMock())
+    
+    assert handler._kv_cache is None
+    assert handler._cached_input_ids is None
+
+def test_compile_forward_falls_back_to_eager():
+    """Test that a failed compile warm-up leaves the model running uncompiled."""
+    torch = pytest.importorskip("torch")
+    pytest.importorskip("transformers")
+    from transformers import GenerationConfig
+    from qllama.models.text.mistral import MistralHandler
+    
+    handler = object.__new__(MistralHandler)
+    handler.device = "cuda"
+    handler.reuse_kv_cache = True
+    handler.tokenizer = MagicMock()
+    handler.model = MagicMock()
+    eager_forward = handler.model.forward
+    handler.model.generate.side_effect = RuntimeError("CUDA graph capture failed")
+    handler._gen_config = GenerationConfig(max_new_tokens=8)
+    
+    with patch("torch.compile", return_value=MagicMock()), patch.object(torch, "__version__", "2.3.0"):
+        handler._compile_forward()
+    
+    assert handler.model.forward is eager_forward
+    assert handler._gen_config.cache_implementation is None
+    assert handler.reuse_kv_cache
+
+def test_image_digest_computed_once():
+    """Test that an image's pixels are hashed once and keyed per image."""
+    from PIL import Image
+    from qllama.models.vision.smolvlm import _image_digest
+    
+    red = Image.new("RGB", (4, 4), "red")
+    blue = Image.new("RGB", (4, 4), "blue")
+    
+    digest = _image_digest(red)
+    with patch.object(red, "tobytes") as mock_tobytes:
+        assert _image_digest(red) == digest
+    mock_tobytes.assert_not_called()
+    assert _image_digest(blue) != digest
+
+def test_prune_feature_cache(tmp_path):
+    """Test that the least recently used feature files are evicted first."""
+    import os
+    from qllama.models.vision import smolvlm
+    
+    handler = object.__new__(smolvlm.SmolVLMHandler)
+    handler._emb_cache_dir = tmp_path
+    handler._emb_cache_max_bytes = 250
+    for mtime, name in enumerate(("oldest", "older", "newer", "newest"), start=1):
+        path = tmp_path / f"{name}.npy"
+        path.write_bytes(b"x" * 100)
+        os.utime(path, (mtime, mtime))
+    
+    handler._prune_feature_cache()
+    
+    assert sorted(path.stem for path in tmp_path.glob("*.npy")) == ["newer", "newest"]
@@ -0,0 +1,219 @@
+"""Tests for the terminal interface."""
+
+import collections
+import os
+import sys
+import threading
+
+import pytest
+from unittest.mock import MagicMock, patch
+
+from qllama.terminal import QllamaTerminal, _PipedInput, _history_size, _trim_history_file
+
+@pytest.fixture
+def terminal():
+    """A terminal instance without a loaded model."""
+    term = object.__new__(QllamaTerminal)
+    term.history = []
+    term.batch_size = 1
+    return term
+
+def test_parse_user_input_attachments(terminal):
+    """Test that attachment tags become content items."""
+    messages, continue_flag = terminal.parse_user_input(
+        "<image:/tmp/a.jpg> compare with <image:https://example.com/b.png> and <video:/tmp/c.mp4>"
+    )
+    
+    assert continue_flag
+    assert messages == [{
+        "role": "user",
+        "content": [
+            {"type": "image", "url": "/tmp/a.jpg"},
+            {"type": "image", "url": "https://example.com/b.png"},
+            {"type": "video", "path": "/tmp/c.mp4"},
+            {"type": "text", "text": "compare with  and"},
+        ],
+    }]
+
+def test_parse_user_input_webp_webm(terminal):
+    """Test that WebP images and WebM videos are recognized, regardless of case."""
+    messages, _ = terminal.parse_user_input("<image:a.WEBP> <video:b.webm>")
+    
+    assert messages[-1]["content"] == [
+        {"type": "image", "url": "a.WEBP"},
+        {"type": "video", "path": "b.webm"},
+    ]
+
+def test_parse_user_input_unknown_extension(terminal):
+    """Test that tags with unknown extensions stay in the text."""
+    messages, _ = terminal.parse_user_input("read <image:notes.txt>")
+    
+    assert messages[-1]["content"] == [{"type": "text", "text": "read <image:notes.txt>"}]
+
+def test_parse_user_input_bounded_history(terminal):
+    """Test that only the most recent turns are sent as context."""
+    terminal.history = collections.deque(maxlen=2)
+    for i in range(3):
+        terminal.history.append({"role": "user", "content": f"question {i}"})
+        terminal.history.append({"role": "assistant", "content": f"answer {i}"})
+    
+    messages, _ = terminal.parse_user_input("question 3")
+    
+    assert [m["content"] for m in messages[:-1]] == ["question 2", "answer 2"]
+
+def test_parse_user_input_exit(terminal):
+    """Test the exit commands."""
+    assert terminal.parse_user_input(" /quit ") == ([], False)
+
+def test_history_size(monkeypatch):
+    """Test reading the history size from the environment."""
+    monkeypatch.delenv("QLLAMA_HISTORY_SIZE", raising=False)
+    assert _history_size() == 1000
+    
+    monkeypatch.setenv("QLLAMA_HISTORY_SIZE", "50")
+    assert _history_size() == 50
+    
+    monkeypatch.setenv("QLLAMA_HISTORY_SIZE", "lots")
+    assert _history_size() == 1000
+    
+    # 0 would empty the history file and -1 makes trimming fail
+    for value in ("0", "-1"):
+        monkeypatch.setenv("QLLAMA_HISTORY_SIZE", value)
+        assert _history_size() == 1000
+
+def test_trim_history_file(tmp_path, monkeypatch):
+    """Test that large history files are trimmed to their last entries."""
+    histfile = tmp_path / ".qllama_history"
+    histfile.write_text("".join(f"prompt {i}\n" for i in range(100)))
+    
+    monkeypatch.setattr("qllama.terminal._HISTORY_TRIM_BYTES", 10)
+    _trim_history_file(str(histfile), 3)
+    
+    assert histfile.read_text() == "prompt 97\nprompt 98\nprompt 99\n"
+
+def test_trim_history_file_keeps_libedit_header(tmp_path, monkeypatch):
+    """Test that trimming keeps the header line libedit needs to read the file."""
+    histfile = tmp_path / ".qllama_history"
+    histfile.write_text("_HiStOrY_V2_\n" + "".join(f"prompt\\040{i}\n" for i in range(100)))
+    
+    monkeypatch.setattr("qllama.terminal._HISTORY_TRIM_BYTES", 10)
+    _trim_history_file(str(histfile), 2)
+    
+    assert histfile.read_text() == "_HiStOrY_V2_\nprompt\\04098\nprompt\\04099\n"
+
+def test_trim_history_file_small(tmp_path):
+    """Test that small history files are left alone."""
+    histfile = tmp_path / ".qllama_history"
+    histfile.write_text("prompt 1\nprompt 2\n")
+    
+    _trim_history_file(str(histfile), 1)
+    
+    assert histfile.read_text() == "prompt 1\nprompt 2\n"
+
+@patch("qllama.terminal.readline")
+def test_load_history_trim_failure(mock_readline, terminal, tmp_path, monkeypatch):
+    """Test that a history file that can't be trimmed is still loaded."""
+    monkeypatch.setattr("qllama.terminal._HISTORY_TRIM_BYTES", 10)
+    histfile = tmp_path / ".qllama_history"
+    histfile.write_text("prompt 1\nprompt 2\nprompt 3\n")
+    
+    with patch("qllama.terminal.os.replace", side_effect=PermissionError("read-only")):
+        terminal._load_history(str(histfile))
+    
+    mock_readline.read_history_file.assert_called_once_with(str(histfile))
+    assert not (tmp_path / ".qllama_history.tmp").exists()
+
+@patch("qllama.terminal.readline")
+def test_load_history_unreadable(mock_readline, terminal, tmp_path):
+    """Test that a history file readline rejects doesn't stop the terminal."""
+    histfile = tmp_path / ".qllama_history"
+    histfile.write_text("prompt 1\n")
+    mock_readline.read_history_file.side_effect = OSError(22, "Invalid argument")
+    
+    terminal._load_history(str(histfile))
+    
+    mock_readline.read_history_file.assert_called_once_with(str(histfile))
+
+@patch("qllama.terminal.readline")
+def test_save_history_entry_fallback_write_failure(mock_readline, terminal):
+    """Test that a failed periodic history rewrite is only logged."""
+    del mock_readline.append_history_file
+    mock_readline.write_history_file.side_effect = OSError("disk full")
+    terminal._unsaved_history = 0
+    
+    for _ in range(10):
+        terminal._save_history_entry("/tmp/.qllama_history")
+    
+    mock_readline.write_history_file.assert_called_once_with("/tmp/.qllama_history")
+    assert terminal._unsaved_history == 0
+
+@pytest.fixture
+def piped_stdin(monkeypatch):
+    """Replace stdin with the read end of a real pipe and return its (unbuffered) write end."""
+    read_fd, write_fd = os.pipe()
+    stdin = os.fdopen(read_fd, "r")
+    writer = os.fdopen(write_fd, "wb", buffering=0)
+    monkeypatch.setattr(sys, "stdin", stdin)
+    yield writer
+    writer.close()
+    stdin.close()
+
+def test_piped_input_queued_lines(piped_stdin):
+    """Test that lines already waiting on a pipe are returned without blocking."""
+    piped_stdin.write(b"a\n\nb\nc\npartial")
+    reader = _PipedInput(sys.stdin.fileno())
+    
+    assert reader.readline() == "a"
+    # The unterminated last line isn't complete yet, so it is left for later
+    assert reader.queued_lines(5) == ["b", "c"]
+    
+    piped_stdin.close()
+    assert reader.readline() == "partial"
+    with pytest.raises(EOFError):
+        reader.readline()
+
+@patch("qllama.terminal.readline")
+def test_run_non_interactive(mock_readline, terminal, piped_stdin, capsys):
+    """Test that scripted runs skip readline history and stop at end of input."""
+    terminal.model_name = "test"
+    terminal.temperature = 1.0
+    terminal.max_tokens = 8
+    terminal.model_handler = MagicMock()
+    terminal.model_handler.generate_stream.return_value = iter(["Hi", " there"])
+    
+    piped_stdin.write(b"hello\n")
+    piped_stdin.close()
+    terminal.run()
+    
+    mock_readline.read_history_file.assert_not_called()
+    mock_readline.append_history_file.assert_not_called()
+    mock_readline.write_history_file.assert_not_called()
+    assert terminal.history[-1] == {"role": "assistant", "content": [{"type": "text", "text": "Hi there"}]}
+    assert "\nUser: hello\n\nqllama: Hi there\n" in capsys.readouterr().out
+
+@patch("qllama.terminal.readline")
+def test_run_batches_queued_inputs(mock_readline, terminal, piped_stdin, capsys):
+    """Test that prompts already waiting on a pipe the producer keeps open are batched."""
+    terminal.model_name = "test"
+    terminal.temperature = 1.0
+    terminal.max_tokens = 8
+    terminal.batch_size = 4
+    terminal.model_handler = MagicMock()
+    terminal.model_handler.generate_batch.return_value = ["first answer", "second answer"]
+    
+    piped_stdin.write(b"first\nsecond\n")
+    # The producer only closes the pipe later, so the reader can't rely on EOF
+    closer = threading.Timer(0.5, piped_stdin.close)
+    closer.start()
+    terminal.run()
+    closer.join()
+    
+    conversations = terminal.model_handler.generate_batch.call_args[0][0]
+    assert [c[-1]["content"][0]["text"] for c in conversations] == ["first", "second"]
+    terminal.model_handler.generate_stream.assert_not_called()
+    assert [m["content"][0]["text"] for m in terminal.history] == [
+        "first", "first answer", "second", "second answer"
+    ]
+    # Every prompt of the batch is echoed before its answer
+    output = capsys.readouterr().out
+    assert "\nUser: first\n\nqllama: first answer\n\nUser: second\n\nqllama: second answer\n" in output
@@ -1,9 +1,17 @@
 """Tests for utility functions."""
 
 import pytest
+import requests
 from unittest.mock import patch, MagicMock
 
-from qllama.utils import is_url, load_image, load_video
+from qllama.utils import _IMAGE_CACHE, is_url, load_attachments, load_image, load_video
+
+@pytest.fixture(autouse=True)
+def clear_image_cache():
+    """Make sure every test loads images from scratch."""
+    _IMAGE_CACHE.clear()
+    yield
+    _IMAGE_CACHE.clear()
 
 def test_is_url():
     """Test is_url function."""
@@ -11,20 +19,20 @@ def test_is_url():
     assert is_url("https://example.com/image.jpg")
     assert not is_url("path/to/file.jpg")
     assert not is_url("/home/user/image.jpg")
+    assert is_url("HTTPS://example.com/image.jpg")
+    assert is_url("ftp://example.com/image.jpg")
+    assert not is_url("C:\\Users\\image.jpg")
+    assert not is_url(None)
 
-@patch("qllama.utils.requests.get")
+@patch("qllama.utils._SESSION.get")
 @patch("qllama.utils.Image")
-@patch("qllama.utils.tempfile.NamedTemporaryFile")
-def test_load_image_from_url(mock_tempfile, mock_pil, mock_requests):
+def test_load_image_from_url(mock_pil, mock_requests):
     """Test loading an image from a URL."""
     # Setup mocks
     mock_response = MagicMock()
+    mock_response.iter_content.return_value = [b"image", b"bytes"]
     mock_requests.return_value = mock_response
     
-    mock_file = MagicMock()
-    mock_file.name = "/tmp/temp_image.jpg"
-    mock_tempfile.return_value.__enter__.return_value = mock_file
-    
     mock_image = MagicMock()
     mock_pil.open.return_value = mock_image
     
@@ -32,17 +40,53 @@ def test_load_image_from_url(mock_tempfile, mock_pil, mock_requests):
     result = load_image("https://example.com/image.jpg")
     
     # Assertions
-    mock_requests.assert_called_once_with("https://example.com/image.jpg", stream=True)
+    mock_requests.assert_called_once_with("https://example.com/image.jpg", stream=True, timeout=(3.05, 30), headers={})
     mock_response.raise_for_status.assert_called_once()
-    mock_pil.open.assert_called_once_with("/tmp/temp_image.jpg")
+    buffer = mock_pil.open.call_args[0][0]
+    assert buffer.getvalue() == b"imagebytes"
+    mock_image.load.assert_called_once()
     assert result == mock_image
 
+@patch("qllama.utils._SESSION.get")
+@patch("qllama.utils.Image")
+def test_load_image_from_url_revalidates(mock_pil, mock_requests):
+    """Test that cached URL images are revalidated with a conditional GET."""
+    first_response = MagicMock()
+    first_response.iter_content.return_value = [b"image"]
+    first_response.headers = {"ETag": '"abc"'}
+    not_modified = MagicMock(status_code=304)
+    mock_requests.side_effect = [first_response, not_modified]
+    
+    first = load_image("https://example.com/image.jpg")
+    second = load_image("https://example.com/image.jpg")
+    
+    assert second is first
+    assert mock_pil.open.call_count == 1
+    assert mock_requests.call_args[1]["headers"] == {"If-None-Match": '"abc"'}
+    # Both responses are released so their connections can be reused
+    first_response.close.assert_called_once()
+    not_modified.close.assert_called_once()
+
+@patch("qllama.utils._SESSION.get")
+def test_load_image_from_url_error_closes_response(mock_requests):
+    """Test that a failed download still releases its response."""
+    mock_response = MagicMock()
+    mock_response.raise_for_status.side_effect = requests.HTTPError("404")
+    mock_requests.return_value = mock_response
+    
+    with pytest.raises(requests.HTTPError):
+        load_image("https://example.com/missing.jpg")
+    
+    mock_response.close.assert_called_once()
+
+@patch("qllama.utils.os.stat")
 @patch("qllama.utils.os.path.isfile")
 @patch("qllama.utils.Image")
-def test_load_image_from_path(mock_pil, mock_isfile):
+def test_load_image_from_path(mock_pil, mock_isfile, mock_stat):
     """Test loading an image from a path."""
     # Setup mocks
     mock_isfile.return_value = True
+    mock_stat.return_value.st_mtime_ns = 1
     mock_image = MagicMock()
     mock_pil.open.return_value = mock_image
     
@@ -53,6 +97,43 @@ def test_load_image_from_path(mock_pil, mock_isfile):
     mock_isfile.assert_called_once_with("/path/to/image.jpg")
     mock_pil.open.assert_called_once_with("/path/to/image.jpg")
     assert result == mock_image
+    
+    # A second load of the unchanged file comes from the cache
+    assert load_image("/path/to/image.jpg") is result
+    mock_pil.open.assert_called_once()
+
+@patch("qllama.utils.os.path.isfile")
+@patch("qllama.utils.Image")
+def test_load_image_cache_disabled(mock_pil, mock_isfile, monkeypatch):
+    """Test that the image cache can be turned off."""
+    monkeypatch.setenv("QLLAMA_DISABLE_IMAGE_CACHE", "1")
+    mock_isfile.return_value = True
+    
+    load_image("/path/to/image.jpg")
+    load_image("/path/to/image.jpg")
+    
+    assert mock_pil.open.call_count == 2
+
+def test_image_cache_byte_bound(tmp_path, monkeypatch):
+    """Test that the image cache evicts old entries once it holds too many pixel bytes."""
+    from PIL import Image
+    
+    # Room for two 10x10 RGB images (300 bytes each), but not three
+    monkeypatch.setattr("qllama.utils._IMAGE_CACHE_MAX_BYTES", 700)
+    paths = []
+    for name in ("a", "b", "c"):
+        path = tmp_path / f"{name}.png"
+        Image.new("RGB", (10, 10)).save(path)
+        paths.append(str(path))
+        load_image(paths[-1])
+    
+    assert [key[0] for key in _IMAGE_CACHE] == paths[1:]
+    
+    # Images larger than the whole budget are returned but not cached
+    big = tmp_path / "big.png"
+    Image.new("RGB", (20, 20)).save(big)
+    assert load_image(str(big)).size == (20, 20)
+    assert [key[0] for key in _IMAGE_CACHE] == paths[1:]
 
 @patch("qllama.utils.os.path.isfile")
 @patch("qllama.utils.cv2")
@@ -70,10 +151,12 @@ def test_load_video(mock_np, mock_pil, mock_cv2, mock_isfile):
     mock_np.linspace.return_value = [0, 3, 6, 9]  # 4 frame indices
     
     frame_data = [MagicMock() for _ in range(4)]
-    pil_images = [MagicMock() for _ in range(4)]
     
-    mock_video.read.side_effect = [(True, frame) for frame in frame_data]
-    mock_pil.fromarray.side_effect = pil_images
+    mock_video.grab.return_value = True
+    mock_video.retrieve.side_effect = [(True, frame) for frame in frame_data]
+    # Frames are converted on a thread pool, so map inputs to outputs rather than relying on call order
+    mock_np.ascontiguousarray.side_effect = lambda array: array
+    mock_pil.fromarray.side_effect = lambda array: ("image", array)
     
     # Call the function
     result = load_video("/path/to/video.mp4")
@@ -81,8 +164,45 @@ def test_load_video(mock_np, mock_pil, mock_cv2, mock_isfile):
     # Assertions
     mock_isfile.assert_called_once_with("/path/to/video.mp4")
     mock_cv2.VideoCapture.assert_called_once_with("/path/to/video.mp4")
-    assert mock_video.read.call_count == 4
-    assert mock_cv2.cvtColor.call_count == 4
+    assert mock_video.grab.call_count == 10
+    assert mock_video.retrieve.call_count == 4
+    mock_video.set.assert_not_called()
+    assert mock_np.ascontiguousarray.call_count == 4
+    mock_cv2.cvtColor.assert_not_called()
     assert mock_pil.fromarray.call_count == 4
     assert len(result) == 4
-    assert result == pil_images
+    assert result == [("image", frame[:, :, ::-1]) for frame in frame_data]
+
+def test_load_image_target_size(tmp_path):
+    """Test that images are shrunk to the target size once and cached per size."""
+    from PIL import Image
+    
+    path = tmp_path / "image.png"
+    Image.new("RGBA", (800, 400)).save(path)
+    
+    resized = load_image(str(path), target_size=(200, 200))
+    
+    assert resized.size == (200, 100)
+    assert resized.mode == "RGB"
+    assert load_image(str(path), target_size=(200, 200)) is resized
+    assert load_image(str(path)).size == (800, 400)
+
+@patch("qllama.utils.load_video")
+@patch("qllama.utils.load_image")
+def test_load_attachments(mock_load_image, mock_load_video):
+    """Test loading the attachments of content items."""
+    mock_load_image.side_effect = lambda url, target_size=None: f"image:{url}"
+    mock_load_video.side_effect = lambda path: [f"frame:{path}"]
+    
+    items = [
+        {"type": "text", "text": "Compare these"},
+        {"type": "image", "url": "a.jpg"},
+        {"type": "video", "path": "c.mp4"},
+        {"type": "image", "url": "b.jpg"},
+        {"type": "image", "url": "a.jpg"},
+    ]
+    images, videos = load_attachments(items)
+    
+    assert images == {"a.jpg": "image:a.jpg", "b.jpg": "image:b.jpg"}
+    assert videos == {"c.mp4": ["frame:c.mp4"]}
+    assert mock_load_image.call_count == 2